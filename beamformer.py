@@ -0,0 +1,216 @@
+import sys
+import numpy as np
+from argparse import ArgumentParser
+from fringe_finder import AlignedDadaReader, open_streams, prefetch
+from dada_reduce import sigproc_header, mjd
+
+BLOCK_SIZE = 1024
+
+def _sum_last(data, out):
+    # Adding strided views beats a reduction over a short last axis
+    np.copyto(out,data[...,0])
+    for ii in range(1,data.shape[-1]):
+        out += data[...,ii]
+
+
+class Beamformer(object):
+    """
+    Forms coherent beams and an incoherent sum from time-aligned antennas.
+
+    weights are complex gains of shape (nbeams, nant, nchan), or anything
+    that broadcasts to it, and delays are (nbeams, nant) seconds to remove,
+    in the convention of find_fringes: the delay of each antenna relative to
+    the reference. Antenna voltages of each beam are multiplied by weight *
+    exp(2 pi i f delay), with f the sky frequency of each channel, and summed. Each block of
+    samples is reordered once into (chan, ant, time*pol) and all beams are
+    formed with one batched complex matrix multiply over channels. The
+    incoherent beam sums the powers of every antenna, scaled by
+    incoherent_weights of shape (nant, nchan), with a second batched
+    multiply. Beams are detected to
+    Stokes I and averaged over tscrunch samples into float32 (nsamps, nchan)
+    blocks. All work buffers are allocated once for the block size, which
+    sets the memory used: the reordered voltages take 8 * nchan * nant *
+    npol bytes per sample.
+    """
+    def __init__(self, reader, weights=None, delays=None, incoherent_weights=None,
+            tscrunch=1, block_size=BLOCK_SIZE):
+        layout = reader.layout
+        if layout.ndim != 2:
+            raise ValueError("Beamforming needs complex voltages")
+        self._reader = reader
+        self.nant = reader.nant
+        self.nchan = layout.nchan
+        self.npol = layout.npol
+        header = reader.streams[0].header
+        self.frequencies = (header["FREQ"] - header["BW"]/2.0 +
+            (np.arange(self.nchan) + 0.5) * header["BW"] / self.nchan) * 1e6
+        weights = np.ones((1,self.nant,1),dtype="complex128") if weights is None else np.asarray(weights)
+        if delays is not None:
+            delays = np.asarray(delays,dtype="float64")
+            weights = weights * np.exp(2j * np.pi * delays[...,None] * self.frequencies)
+        if weights.ndim > 3:
+            raise ValueError("Weights must broadcast to (nbeams, nant, nchan)")
+        weights = weights.reshape((1,)*(3-weights.ndim)+weights.shape)
+        self.nbeams = weights.shape[0]
+        weights = np.broadcast_to(weights,(self.nbeams,self.nant,self.nchan))
+        # (chan, beam, ant), the left operand of the batched multiply
+        self._weights = np.ascontiguousarray(weights.transpose(2,0,1),dtype="complex64")
+        incoherent_weights = np.ones((self.nant,self.nchan)) if incoherent_weights is None else incoherent_weights
+        incoherent_weights = np.broadcast_to(incoherent_weights,(self.nant,self.nchan))
+        self._incoherent_weights = np.ascontiguousarray(incoherent_weights.T[:,None,:],dtype="float32")
+        self.tscrunch = tscrunch
+        self.block_size = max(block_size // tscrunch,1) * tscrunch
+        self._buffers = None
+
+    def _allocate(self, nsamps):
+        nchan,nant,nbeams,npol = self.nchan,self.nant,self.nbeams,self.npol
+        return {
+            "volts": np.empty((nchan,nant,nsamps*npol),dtype="complex64"),
+            "beams": np.empty((nchan,nbeams,nsamps*npol),dtype="complex64"),
+            "incoherent": np.empty((nchan,1,nsamps*npol*2),dtype="float32"),
+            "detected": np.empty((nchan,nbeams+1,nsamps),dtype="float32"),
+            "output": np.empty((nbeams+1,nsamps//self.tscrunch,nchan),dtype="float32")
+            }
+
+    def form(self, raw):
+        """
+        Beamform a raw (chan, ant, time, pol, ndim) block.
+
+        Returns float32 (nbeams+1, nsamps/tscrunch, nchan) powers, the
+        coherent beams followed by the incoherent beam, in a buffer that is
+        reused by the next call.
+        """
+        nsamps = raw.shape[2] // self.tscrunch * self.tscrunch
+        if nsamps == self.block_size:
+            if self._buffers is None:
+                self._buffers = self._allocate(nsamps)
+            buf = self._buffers
+        else:
+            buf = self._allocate(nsamps)
+        nchan,nant,nbeams = self.nchan,self.nant,self.nbeams
+        volts = buf["volts"]
+        np.copyto(volts.view("float32").reshape(nchan,nant,nsamps,self.npol,2),raw[:,:,:nsamps])
+        np.matmul(self._weights,volts,out=buf["beams"])
+        detected = buf["detected"]
+        beams = buf["beams"].view("float32")
+        np.square(beams,out=beams)
+        _sum_last(beams.reshape(nchan,nbeams,nsamps,-1),detected[:,:nbeams])
+        # The voltages are not needed once the beams are formed
+        power = volts.view("float32")
+        np.square(power,out=power)
+        np.matmul(self._incoherent_weights,power,out=buf["incoherent"])
+        _sum_last(buf["incoherent"].reshape(nchan,1,nsamps,-1),detected[:,nbeams:])
+        output = buf["output"]
+        _sum_last(detected.reshape(nchan,nbeams+1,nsamps//self.tscrunch,self.tscrunch),
+            output.transpose(2,0,1))
+        output *= 1.0 / self.tscrunch
+        return output
+
+    def nsamps(self, start=0, count=None):
+        count = self._reader.nsamps - start if count is None else count
+        return count // self.tscrunch
+
+    def blocks(self, start=0, count=None):
+        """
+        Yield beamformed blocks of the common span of the antennas, reading
+        the next block while the current one is formed.
+
+        Antennas are read straight into channel-major buffers, so the
+        reordering for the matrix multiply happens on the reader threads.
+        """
+        end = start + self.nsamps(start,count) * self.tscrunch
+        ranges = [(block_start,min(self.block_size,end-block_start))
+            for block_start in range(start,end,self.block_size)]
+        layout = self._reader.layout
+        shape = (self.nchan,self.nant,self.block_size,layout.npol,layout.ndim)
+        buffers = [np.empty(shape,dtype=layout.dtype) for _ in range(2)]
+        def fill(block,buf):
+            raw = buf[:,:,:block[1]]
+            self._reader.read(block[0],block[1],raw.transpose(1,2,0,3,4),raw=True)
+            return raw
+        for raw in prefetch(ranges,fill,buffers):
+            yield self.form(raw)
+
+    def filterbank_header(self, beam, start=0):
+        header = self._reader.streams[0].header
+        foff = header["BW"] / self.nchan
+        tsamp = header["TSAMP"] * 1e-6
+        start_seconds = (self._reader.start_sample + start) * tsamp
+        name = "{}_ib".format(header.get("SOURCE","unknown")) if beam == self.nbeams else \
+            "{}_cb{:02d}".format(header.get("SOURCE","unknown"),beam)
+        return sigproc_header([
+            ("source_name",name),
+            ("data_type",1),
+            ("fch1",header["FREQ"] - header["BW"]/2.0 + foff/2.0),
+            ("foff",foff),
+            ("nchans",self.nchan),
+            ("nbits",32),
+            ("nifs",1),
+            ("tstart",mjd(header["UTC_START"]) + start_seconds/86400.0),
+            ("tsamp",tsamp * self.tscrunch)
+            ])
+
+    def filenames(self, prefix):
+        return ["{}_cb{:02d}.fil".format(prefix,beam) for beam in range(self.nbeams)] + \
+            ["{}_ib.fil".format(prefix)]
+
+    def write(self, prefix, start=0, count=None):
+        """
+        Stream every beam to its own SIGPROC filterbank file, named
+        {prefix}_cb{beam}.fil for the coherent beams and {prefix}_ib.fil for
+        the incoherent beam.
+
+        Returns the number of output samples written to each file.
+        """
+        files = [open(fname,"wb") for fname in self.filenames(prefix)]
+        nsamps = 0
+        try:
+            for beam,f in enumerate(files):
+                f.write(self.filterbank_header(beam,start))
+            for block in self.blocks(start,count):
+                for beam,f in enumerate(files):
+                    block[beam].tofile(f)
+                nsamps += block.shape[1]
+        finally:
+            for f in files:
+                f.close()
+        return nsamps
+
+
+def make_parser():
+    usage = "usage: {prog} [options] filestem [filestem ...]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('filestems', type=str, nargs='+',
+        help='The DADA file stems of the antennas, e.g. obs_00_01024 obs_01_01024')
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-o','--output', dest='output', type=str, required=True,
+        help='The prefix of the filterbank files to write, one per beam.')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-w','--weights', dest='weights', type=str,
+        default=None, help='A .npy file of complex (nbeams, nant, nchan) beam weights. Default is one beam of unit weights.')
+    optional.add_argument('-d','--delays', dest='delays', type=str,
+        default=None, help='A .npy file of (nbeams, nant) delays in seconds to remove from each antenna, as found by fringe_finder.')
+    optional.add_argument('-t','--tscrunch', dest='tscrunch', type=int,
+        default=1, help='The number of samples to average (default is 1).')
+    optional.add_argument('-s','--start', dest='start', type=int,
+        default=0, help='The first sample of the common span to beamform (default is 0).')
+    optional.add_argument('-n','--count', dest='count', type=int,
+        default=None, help='The number of samples to beamform. Default is all of them.')
+    optional.add_argument('-b','--block_size', dest='block_size', type=int,
+        default=BLOCK_SIZE, help='The number of samples beamformed at a time (default is {}).'.format(BLOCK_SIZE))
+    optional.add_argument('-j','--nthreads', dest='nthreads', type=int,
+        default=None, help='The number of threads reading antennas (default is one per antenna).')
+    optional.add_argument('--rescan', dest='rescan', action='store_true',
+        help='Rebuild the catalogs of the DADA directories.')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    weights = None if opts.weights is None else np.load(opts.weights)
+    delays = None if opts.delays is None else np.load(opts.delays)
+    reader = AlignedDadaReader(open_streams(opts.filestems,opts.rescan),opts.nthreads)
+    beamformer = Beamformer(reader,weights,delays,tscrunch=opts.tscrunch,block_size=opts.block_size)
+    nsamps = beamformer.write(opts.output,opts.start,opts.count)
+    reader.close()
+    print "Wrote {} samples of {} beams to {}".format(nsamps,beamformer.nbeams+1,
+        ", ".join(beamformer.filenames(opts.output)))
@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from argparse import ArgumentParser
+from pcap_to_dada import dada_defaults, render_dada_header, DADA_HEADER_SIZE
+from fringe_finder import open_streams, find_fringes, AlignedDadaReader
+from beamformer import Beamformer
+
+FREQ_MHZ = 1284.0
+BW_MHZ = 856.0
+AMPLITUDE = 40.0
+
+def write_antennas(directory, delays, nchan, nsamps, seed):
+    """
+    Write one DADA file per antenna holding a common noise signal, each
+    antenna delayed by its entry of delays in seconds.
+
+    Delays are applied as the phase 2 pi f delay at the sky frequency of
+    each channel, which is how the beamformer removes them.
+    """
+    rng = np.random.RandomState(seed)
+    shape = (nsamps,nchan,2)
+    signal = AMPLITUDE * (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)) / np.sqrt(2)
+    frequencies = (FREQ_MHZ - BW_MHZ/2 + (np.arange(nchan) + 0.5) * BW_MHZ / nchan) * 1e6
+    header = dada_defaults()
+    header.update(nchan=nchan,frequency_mhz=FREQ_MHZ,bandwidth=BW_MHZ,tsamp=nchan/BW_MHZ,
+        utc_start="2020-01-01-00:00:00",filesize=nsamps*nchan*2*2)
+    text = render_dada_header(header).ljust(DADA_HEADER_SIZE,"\0")
+    filestems = []
+    for ant,delay in enumerate(delays):
+        volts = signal * np.exp(-2j * np.pi * frequencies[:,None] * delay)
+        data = np.empty(shape+(2,),dtype="int8")
+        data[...,0] = np.clip(np.round(volts.real),-127,127)
+        data[...,1] = np.clip(np.round(volts.imag),-127,127)
+        filestem = os.path.join(directory,"obs_{:02d}_00000".format(ant))
+        with open(filestem+"_0000000000000000.dada","wb") as f:
+            f.write(text)
+            data.tofile(f)
+        filestems.append(filestem)
+    return filestems
+
+def run_benchmark(opts):
+    """
+    Inject delays into synthetic antennas, find them with find_fringes and
+    beamform with the delays found.
+
+    The delays must be recovered to within the resolution of the fringe
+    search and the coherent beam must then have nant times the power of the
+    incoherent beam, up to quantisation noise.
+    """
+    resolution = 1 / (BW_MHZ * 1e6 * opts.pad)
+    rng = np.random.RandomState(opts.seed)
+    steps = rng.randint(-opts.nchan*opts.pad//4,opts.nchan*opts.pad//4,opts.nantennas)
+    steps[0] = 0
+    injected = steps * resolution
+    workdir = tempfile.mkdtemp(prefix="beamformer_bench_")
+    try:
+        filestems = write_antennas(workdir,injected,opts.nchan,opts.nsamps,opts.seed)
+        streams = open_streams(filestems)
+        start = time.time()
+        fringes = find_fringes(streams,nint=opts.nint,pad=opts.pad)
+        fringe_seconds = time.time() - start
+        reference = fringes[fringes["ant1"] == 0]
+        delays = np.zeros((1,opts.nantennas))
+        delays[0,reference["ant2"]] = reference["delay"]
+        reader = AlignedDadaReader(streams)
+        beamformer = Beamformer(reader,delays=delays,block_size=opts.block_size)
+        power = np.zeros(2)
+        start = time.time()
+        for block in beamformer.blocks():
+            power += block.sum(axis=(1,2))
+        beamform_seconds = time.time() - start
+        reader.close()
+    finally:
+        if opts.keep:
+            print "Kept benchmark files in",workdir
+        else:
+            shutil.rmtree(workdir)
+    delay_errors = np.abs(delays[0] - injected)
+    ratio = power[0] / power[1]
+    return {
+        "time": time.time(),
+        "options": vars(opts),
+        "injected_delays": injected.tolist(),
+        "found_delays": delays[0].tolist(),
+        "fringe_seconds": fringe_seconds,
+        "beamform_seconds": beamform_seconds,
+        "samples_per_second": opts.nsamps / beamform_seconds,
+        "coherent_gain": ratio,
+        "passed": bool(delay_errors.max() < resolution / 2 and ratio > 0.99 * opts.nantennas)
+    }
+
+def make_parser():
+    usage = "usage: {prog} [options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-a','--nantennas', dest='nantennas', type=int,
+        default=4, help='The number of antennas (default is 4).')
+    optional.add_argument('-c','--nchan', dest='nchan', type=int,
+        default=64, help='The number of channels (default is 64).')
+    optional.add_argument('-n','--nsamps', dest='nsamps', type=int,
+        default=8192, help='The number of samples per antenna (default is 8192).')
+    optional.add_argument('--nint', dest='nint', type=int,
+        default=256, help='The number of spectra in each fringe search integration (default is 256).')
+    optional.add_argument('--pad', dest='pad', type=int,
+        default=4, help='The zero-padding factor of the fringe search (default is 4).')
+    optional.add_argument('-b','--block_size', dest='block_size', type=int,
+        default=1024, help='The number of samples beamformed at a time (default is 1024).')
+    optional.add_argument('--seed', dest='seed', type=int,
+        default=0, help='The random seed for the signal and delays (default is 0).')
+    optional.add_argument('--results', dest='results', type=str,
+        default=None, help='Append the results as a line of JSON to this file.')
+    optional.add_argument('--keep', dest='keep', action='store_true',
+        help='Keep the generated files.')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    results = run_benchmark(opts)
+    print json.dumps(results,indent=1)
+    if opts.results is not None:
+        with open(opts.results,"a") as f:
+            f.write(json.dumps(results)+"\n")
+    if not results["passed"]:
+        sys.exit(1)
@@ -0,0 +1,141 @@
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from argparse import ArgumentParser
+import pcap_to_dada
+from pcap_to_dada import NSAMPS_PER_PACKET, NPOL
+from fringe_finder import DadaFileStream
+from spead_pcap_generator import generate_pcap, payload_pattern
+
+def read_stream(stem, nchans):
+    """
+    Read the heaps written for one stream, across all rolled over files.
+
+    Files are read through DadaFileStream, so compressed output is checked
+    too.
+    """
+    files = glob.glob(stem+"_*.dada")
+    if not files:
+        return np.empty((0,NSAMPS_PER_PACKET,nchans,NPOL,2),dtype="int8")
+    stream = DadaFileStream(files)
+    data = stream.extract(0,stream.nsamps).raw()
+    stream.close()
+    return data.reshape(-1,NSAMPS_PER_PACKET,nchans,NPOL,2)
+
+def verify_outputs(prefix, emitted, nchans_per_subband):
+    """
+    Check converted files against the payloads injected by the generator.
+
+    Each stream starts at the heap of its first packet in the capture. Every
+    later packet must appear at its heap and channel and every slot that no
+    packet was sent for must be zero.
+    """
+    results = {"streams":0, "packets":0, "mismatched":0, "unexpected_data":0, "length_mismatch":0}
+    streams = np.unique(emitted[["feng_id","frequency"]].astype([("feng_id","int32"),("frequency","int32")]))
+    for feng_id,frequency in streams:
+        sent = emitted[(emitted["feng_id"] == feng_id) & (emitted["frequency"] == frequency)]
+        base = sent["heap"][0]
+        sent = sent[sent["heap"] >= base]
+        data = read_stream("%s_%02d_%05d"%(prefix,feng_id,frequency),nchans_per_subband)
+        nheaps = sent["heap"].max() - base + 1
+        if data.shape[0] != nheaps:
+            results["length_mismatch"] += 1
+        written = sent[sent["heap"] - base < data.shape[0]]
+        got = data[written["heap"]-base,:,written["channel"]]
+        expected = payload_pattern(written["feng_id"],written["frequency"],written["heap"],written["channel"])
+        results["mismatched"] += int((got != expected).reshape(written.size,-1).any(axis=1).sum())
+        results["mismatched"] += sent.size - written.size
+        filled = np.zeros(data.shape[:1]+data.shape[2:3],dtype="bool")
+        filled[written["heap"]-base,written["channel"]] = True
+        results["unexpected_data"] += int(np.count_nonzero(data.transpose(0,2,1,3,4)[~filled]))
+        results["packets"] += int(sent.size)
+        results["streams"] += 1
+    results["passed"] = not (results["mismatched"] or results["unexpected_data"] or results["length_mismatch"])
+    return results
+
+def run_benchmark(opts, converter_args):
+    """
+    Generate a capture, convert it with pcap_to_dada and verify the output.
+
+    Stage timings come from the converter statistics. When files are written
+    in the foreground the write time is taken out of the heap assembly time.
+    """
+    workdir = tempfile.mkdtemp(prefix="pcap_to_dada_bench_")
+    try:
+        pcap = os.path.join(workdir,"bench.pcap")
+        start = time.time()
+        emitted = generate_pcap(pcap,opts.nantennas,opts.nsubbands,opts.nchans_per_subband,
+            opts.nheaps,opts.loss,opts.reorder,opts.seed)
+        generate_seconds = time.time() - start
+        prefix = os.path.join(workdir,"out")
+        converter_opts = pcap_to_dada.make_parser().parse_args(
+            ["-i",pcap,"-c",str(opts.nchan),"-p",prefix] + converter_args)
+        start = time.time()
+        stats = pcap_to_dada.main(converter_opts).stats()
+        convert_seconds = time.time() - start
+        verification = verify_outputs(prefix,emitted,opts.nchans_per_subband)
+    finally:
+        if opts.keep:
+            print "Kept benchmark files in",workdir
+        else:
+            shutil.rmtree(workdir)
+    assembly_seconds = stats["assemble"]["seconds"]
+    if not converter_opts.background_writer:
+        assembly_seconds -= stats["write"]["seconds"]
+    return {
+        "time": time.time(),
+        "generator": vars(opts),
+        "converter_args": converter_args,
+        "packets": int(emitted.size),
+        "bytes": int(emitted.size * pcap_to_dada.SPEAD_FRAME_SIZE),
+        "generate_seconds": generate_seconds,
+        "convert_seconds": convert_seconds,
+        "packets_per_second": emitted.size / convert_seconds,
+        "stage_seconds": {
+            "parse": stats["decode"]["seconds"],
+            "heap_assembly": assembly_seconds,
+            "dada_write": stats["write"]["seconds"]
+        },
+        "verification": verification
+    }
+
+def make_parser():
+    usage = "usage: {prog} [options] [pcap_to_dada options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-a','--nantennas', dest='nantennas', type=int,
+        default=16, help='The number of F-engines (default is 16).')
+    optional.add_argument('-s','--nsubbands', dest='nsubbands', type=int,
+        default=4, help='The number of subbands per F-engine (default is 4).')
+    optional.add_argument('--nchans_per_subband', dest='nchans_per_subband', type=int,
+        default=16, help='The number of channels in each heap (default is 16).')
+    optional.add_argument('--heaps', dest='nheaps', type=int,
+        default=32, help='The number of heaps per stream (default is 32). Use --nheaps to set the converter reorder window.')
+    optional.add_argument('-l','--loss', dest='loss', type=float,
+        default=0.0, help='The fraction of packets to drop (default is 0).')
+    optional.add_argument('-r','--reorder', dest='reorder', type=int,
+        default=0, help='The maximum number of places a packet is displaced by (default is 0).')
+    optional.add_argument('--seed', dest='seed', type=int,
+        default=0, help='The random seed for loss and reordering (default is 0).')
+    optional.add_argument('-c','--nchan', dest='nchan', type=int,
+        default=4096, help='The number of F-engine channels passed to pcap_to_dada (default is 4096).')
+    optional.add_argument('--results', dest='results', type=str,
+        default=None, help='Append the results as a line of JSON to this file.')
+    optional.add_argument('--keep', dest='keep', action='store_true',
+        help='Keep the generated capture and converted files.')
+    return parser
+
+if __name__ == "__main__":
+    opts,converter_args = make_parser().parse_known_args()
+    results = run_benchmark(opts,converter_args)
+    print json.dumps(results,indent=1)
+    if opts.results is not None:
+        with open(opts.results,"a") as f:
+            f.write(json.dumps(results)+"\n")
+    if not results["verification"]["passed"]:
+        sys.exit(1)
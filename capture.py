@@ -1,8 +1,11 @@
 from subprocess import Popen, PIPE
 import os, atexit
+from dada_header import make_header
+from dada_buffers import DadaBuffer, DadaBufferPool
+from pipeline_worker import WarmPipeline
 
-HEADER_MAKER = "/home/pulsar/scripts/freq_calc.py"
-HEADER = "/tmp/header.txt"
+# The rings are created once and reused by every capture
+DADA_BUFFERS = [DadaBuffer("dada"), DadaBuffer("caca")]
 
 UDP2DB = ("nvidia-docker run "
     "-u 50000:50000 "
@@ -17,7 +20,7 @@ UDP2DB = ("nvidia-docker run "
     "--rm "
     "-e LD_PRELOAD=libvma.so "
     "srx00:5000/dspsr:cuda8.0 "
-    "udp2db -s {tobs} -p 7148 -m {group} -H /tmp/header.txt -a {feng_id} -i {interface} -t {epoch}")
+    "udp2db -s {tobs} -p 7148 -m {group} -H {header} -a {feng_id} -i {interface} -t {epoch}")
 
 FENG2DADA = ("nvidia-docker run -d "
     "-u 50000:50000 "
@@ -49,6 +52,28 @@ DSPSR = ("nvidia-docker run -d "
     "srx00:5000/dspsr:cuda8.0 "
     "dspsr -N {psr} -L 2 -t 12 -U 1")
 
+# Warm captures run each stage's worker in a container that lives for the
+# whole session, so only the stage processes start per capture, not the
+# containers. The image must provide python 2 to run the worker, and the
+# capture directories are mounted at the same path as on the host.
+WORKER_RUNTIME = ("nvidia-docker run "
+    "-u 50000:50000 "
+    "--net=host "
+    "--ulimit memlock=-1 "
+    "--device=/dev/infiniband/rdma_cm "
+    "--device=/dev/infiniband/uverbs0 "
+    "--device=/dev/infiniband/uverbs1 "
+    "-v /tmp/:/tmp/ "
+    "-v {worker_dir}:{worker_dir}:ro "
+    "-v {base_path}:{base_path} "
+    "--ipc=host "
+    "--name {name}_worker "
+    "--rm "
+    "srx00:5000/dspsr:cuda8.0 "
+    "python {worker} --socket {socket}")
+PIPELINE_STAGES = ("dada_dbdisk", "feng2dada", "udp2db")
+FENG2DADA_TOOL = "/home/psr/software/psrdada_cpp/build/psrdada_cpp/meerkat/tools/feng2dada"
+
 DADADB = ("docker run "
     "-u 50000:50000 "
     "--ulimit memlock=-1 "
@@ -57,53 +82,86 @@ DADADB = ("docker run "
     "--rm "
     "srx00:5000/dspsr:cuda8.0 {}")
 
+# The ring tools of warm captures run in the dada_dbdisk worker container,
+# which shares the host IPC namespace, so scrubbing the rings between
+# groups starts no containers
+WORKER_DADADB = "docker exec dada_dbdisk_worker {}"
+
 def make_dada_key_string(key):
     return "DADA INFO:\nkey {0}".format(key)
 
-def reset_dada_buffers():
-    os.system(DADADB.format("dada_db -d -k dada"))
-    os.system(DADADB.format("dada_db -n 20 -b 209715200 -l -p -k dada"))
-    os.system(DADADB.format("dada_db -d -k caca"))
-    os.system(DADADB.format("dada_db -k caca -n 20 -b 209715200 -l -p"))
-
-def make_header(group_id, filter_id):
-    cmd = "python {} -a 4 -g {} -f {} -d > {}".format(
-        HEADER_MAKER, group_id, filter_id, HEADER)
-    os.system(cmd)
+def make_buffer_pool(wrapper=DADADB):
+    pool = DadaBufferPool(DADA_BUFFERS, wrapper=wrapper)
+    pool.ensure()
+    return pool
 
-def capture(group_id, filter_id, out_path, tobs, feng_id, interface, epoch):
+def capture(group_id, filter_id, out_path, tobs, feng_id, interface, epoch, pool=None):
     group = "239.2.1.{}".format(150+group_id)
-    reset_dada_buffers()
-    make_header(group_id, filter_id)
+    (make_buffer_pool() if pool is None else pool).reset()
+    header = make_header(group_id, filter_id)
     cmd = DADADBDISK.format(output=out_path)
     print cmd
     os.system(cmd)
     print FENG2DADA
     os.system(FENG2DADA)
-    cmd = UDP2DB.format(tobs=tobs, group=group,
+    cmd = UDP2DB.format(tobs=tobs, group=group, header=header,
         feng_id=feng_id, interface=interface, epoch=epoch)
     print cmd
     os.system(cmd)
     os.system("docker kill feng2dada")
     os.system("docker kill dada_dbdisk")
+    os.remove(header)
 
-def capture_psr(group_id, filter_id, out_path, tobs, feng_id, psr):
+def capture_psr(group_id, filter_id, out_path, tobs, feng_id, psr, pool=None):
     group = "239.2.1.{}".format(150+group_id)
-    reset_dada_buffers()
-    reset_dada_buffers()
-    make_header(group_id, filter_id)
+    (make_buffer_pool() if pool is None else pool).reset()
+    header = make_header(group_id, filter_id)
     os.system(DSPSR.format(psr=psr, output=out_path))
     os.system(FENG2DADA)
-    os.system(UDP2DB.format(tobs=tobs, group=group))
+    os.system(UDP2DB.format(tobs=tobs, group=group, header=header))
     os.system("docker kill feng2dada")
     os.system("docker kill dspsr")
+    os.remove(header)
+
+def start_pipeline(base_path, runtime=WORKER_RUNTIME):
+    pipeline = WarmPipeline(PIPELINE_STAGES, runtime, base_path=os.path.abspath(base_path))
+    for stage, seconds in sorted(pipeline.start().items()):
+        print "{} worker ready after {:.2f} s".format(stage, seconds)
+    return pipeline
+
+def capture_warm(pipeline, group_id, filter_id, out_path, tobs, feng_id, interface, epoch, pool):
+    group = "239.2.1.{}".format(150+group_id)
+    pool.reset()
+    header = make_header(group_id, filter_id)
+    log = os.path.join(out_path, "capture.log")
+    try:
+        pipeline.run("dada_dbdisk", "dada_dbdisk -k caca -D {}".format(os.path.abspath(out_path)), log=log)
+        pipeline.run("feng2dada", "{} -i dada -o caca -c 256 --log_level=debug".format(FENG2DADA_TOOL), log=log)
+        cmd = "udp2db -s {} -p 7148 -m {} -H {} -a {} -i {} -t {}".format(
+            tobs, group, header, feng_id, interface, epoch)
+        pipeline.run("udp2db", cmd, env={"LD_PRELOAD": "libvma.so"}, log=log)
+        pipeline.wait("udp2db")
+    finally:
+        for stage in ("udp2db", "feng2dada", "dada_dbdisk"):
+            pipeline.stop(stage)
+        os.remove(header)
 
-def cycle_capture(filter_id, tobs, base_path):
-    for group_id in range(16):
-        out_path = os.path.join(base_path,"group_%02d"%(group_id))
-        try:
-            os.mkdir(out_path)
-        except Exception as error:
-            print error
-        capture(group_id, filter_id, out_path, tobs)
+def cycle_capture(filter_id, tobs, base_path, feng_id, interface, epoch, warm=False,
+        runtime=WORKER_RUNTIME, ring_wrapper=WORKER_DADADB):
+    pipeline = start_pipeline(base_path, runtime) if warm else None
+    try:
+        pool = make_buffer_pool(ring_wrapper if warm else DADADB)
+        for group_id in range(16):
+            out_path = os.path.join(base_path,"group_%02d"%(group_id))
+            try:
+                os.mkdir(out_path)
+            except Exception as error:
+                print error
+            if pipeline is not None:
+                capture_warm(pipeline, group_id, filter_id, out_path, tobs, feng_id, interface, epoch, pool)
+            else:
+                capture(group_id, filter_id, out_path, tobs, feng_id, interface, epoch, pool=pool)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
 
@@ -0,0 +1,162 @@
+import collections
+import glob
+import json
+import os
+import threading
+import time
+
+MONITOR_INTERVAL = 1.0
+OVERFLOW_FRACTION = 0.8
+
+_log_lock = threading.Lock()
+
+def monitored_rings(pool):
+    """
+    Return the rings of a udp2db -> feng2dada -> dada_dbdisk pool, as
+    (ring, stage writing it, stage reading it) for a CaptureMonitor.
+    """
+    dada, caca = pool.buffers
+    return [(dada, "udp2db", "feng2dada"), (caca, "feng2dada", "dada_dbdisk")]
+
+
+class OutputDrain(threading.Thread):
+    """
+    Reads the output of a child process as it is produced, so the child
+    never blocks on a full pipe.
+
+    Lines are prefixed with the stage name and appended to log, if given,
+    and the last keep lines are kept for error reports.
+    """
+    def __init__(self, name, stream, log=None, keep=100):
+        super(OutputDrain, self).__init__(name="drain-{}".format(name))
+        self.daemon = True
+        self._stream = stream
+        self._log = log
+        self.lines = collections.deque(maxlen=keep)
+        self.start()
+
+    def run(self):
+        prefix = self.name.split("-", 1)[1]
+        for line in iter(self._stream.readline, ""):
+            self.lines.append(line.rstrip("\n"))
+            if self._log is not None:
+                with _log_lock:
+                    self._log.write("{}: {}".format(prefix, line))
+                    self._log.flush()
+        self._stream.close()
+
+
+class CaptureMonitor(object):
+    """
+    Samples the state of a running capture every interval seconds.
+
+    rings is a list of (DadaBuffer, writer stage, reader stage) tuples whose
+    counters are read through the DadaBufferPool, and the output directory
+    is watched for DADA file growth. Each sample records the fill of every
+    ring, the rates at which its writer and reader moved data and the rate
+    data reached disk. A sample is flagged when a ring is more than
+    overflow_fraction full, or when a ring is filling because its reader
+    is slower than its writer, naming that reader as the bottleneck.
+    """
+    def __init__(self, pool, rings, out_path, interval=MONITOR_INTERVAL,
+            overflow_fraction=OVERFLOW_FRACTION):
+        self._pool = pool
+        self._rings = rings
+        self._out_path = out_path
+        self._interval = interval
+        self._overflow_fraction = overflow_fraction
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous = None
+        self.samples = []
+
+    def _file_bytes(self):
+        total = 0
+        for fname in glob.glob(os.path.join(self._out_path, "*.dada")):
+            try:
+                total += os.path.getsize(fname)
+            except OSError:
+                pass
+        return total
+
+    def sample(self):
+        now = time.time()
+        state = {"time": now, "file_bytes": self._file_bytes(), "rings": {}}
+        for buf, writer, reader in self._rings:
+            state["rings"][buf.key] = self._pool.metrics(buf)
+        record = {
+            "time": now,
+            "file_bytes": state["file_bytes"],
+            "rings": {},
+            "alerts": []
+            }
+        previous = self._previous
+        dt = now - previous["time"] if previous is not None else None
+        if dt:
+            record["disk_MBps"] = (state["file_bytes"] - previous["file_bytes"]) / dt / 1e6
+        for buf, writer, reader in self._rings:
+            metrics = state["rings"][buf.key]
+            if metrics is None:
+                record["rings"][buf.key] = None
+                continue
+            ring = {
+                "full": metrics["full"],
+                "nbufs": metrics["nbufs"],
+                "fill": metrics["full"] / float(metrics["nbufs"]) if metrics["nbufs"] else 0.0
+                }
+            last = previous["rings"].get(buf.key) if previous is not None else None
+            if dt and last is not None:
+                ring["write_MBps"] = (metrics["written"] - last["written"]) * buf.bufsz / dt / 1e6
+                ring["read_MBps"] = (metrics["read"] - last["read"]) * buf.bufsz / dt / 1e6
+                if metrics["full"] > last["full"] and ring["read_MBps"] < ring["write_MBps"]:
+                    record["alerts"].append("{} is the bottleneck: reading {} at {:.1f} MB/s, written at {:.1f} MB/s".format(
+                        reader, buf.key, ring["read_MBps"], ring["write_MBps"]))
+            if ring["fill"] >= self._overflow_fraction:
+                record["alerts"].append("{} ring is {:.0%} full and about to overflow".format(buf.key, ring["fill"]))
+            record["rings"][buf.key] = ring
+        self._previous = state
+        self.samples.append(record)
+        for alert in record["alerts"]:
+            print "WARNING:", alert
+        return record
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self._interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="capture-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sample()
+
+    def summary(self):
+        """
+        Return the peak fill of every ring, the mean rate to disk and every
+        alert raised.
+        """
+        rates = [record["disk_MBps"] for record in self.samples if "disk_MBps" in record]
+        peak_fill = {}
+        for record in self.samples:
+            for key, ring in record["rings"].items():
+                if ring is not None:
+                    peak_fill[key] = max(peak_fill.get(key, 0.0), ring["fill"])
+        return {
+            "nsamples": len(self.samples),
+            "peak_fill": peak_fill,
+            "mean_disk_MBps": sum(rates) / len(rates) if rates else None,
+            "alerts": [alert for record in self.samples for alert in record["alerts"]]
+            }
+
+    def dump(self, fname):
+        with open(fname, "w") as f:
+            for record in self.samples:
+                f.write(json.dumps(record) + "\n")
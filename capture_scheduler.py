@@ -0,0 +1,325 @@
+import atexit
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import Queue
+from argparse import ArgumentParser
+from dada_buffers import DadaBuffer, DadaBufferPool
+from capture_monitor import CaptureMonitor, MONITOR_INTERVAL, monitored_rings
+from dada_header import make_header
+import capture_srx00
+
+POLL_INTERVAL = 0.1
+MULTICAST_BASE = "239.2.1.{}"
+NGROUPS = 16
+
+# The ring udp2db writes to when it is not given a key, as in capture_srx00
+UDP2DB_DEFAULT_KEY = "dada"
+
+# Per stage command templates, filled from the capture and its slot. The
+# udp2db options are only added when needed, so the first slot on the
+# default interface runs udp2db as capture_srx00 does
+COMMANDS = {
+    "dada_dbdisk": "dada_dbdisk -k {output_key} -D {out_path}",
+    "feng2dada": "taskset -c {cores} " + capture_srx00.FENG2DADA + " -i {input_key} -o {output_key} -c 256",
+    "udp2db": ("taskset -c {cores} " + capture_srx00.UDPDB +
+        " -s {tobs} -p 7148 -m {group} -H {header}{udp2db_options}")
+    }
+ENVIRONMENT = {
+    "udp2db": {"LD_PRELOAD": "libvma.so"}
+    }
+
+_live_processes = set()
+_live_lock = threading.Lock()
+
+def _stop_live_processes():
+    with _live_lock:
+        processes = list(_live_processes)
+    for process in processes:
+        process.stop()
+
+atexit.register(_stop_live_processes)
+
+
+class ManagedProcess(object):
+    """
+    A supervised child process.
+
+    The process is started without a shell and tracked until it has been
+    reaped, so stop() (and the atexit handler) always leave nothing behind:
+    it is sent SIGTERM and then SIGKILL if it has not exited after grace
+    seconds.
+    """
+    def __init__(self, name, cmd, env=None, log=None):
+        self.name = name
+        self.cmd = cmd
+        environ = os.environ.copy()
+        environ.update(env or {})
+        self._process = subprocess.Popen(shlex.split(cmd), env=environ,
+            stdout=log, stderr=subprocess.STDOUT if log is not None else None)
+        with _live_lock:
+            _live_processes.add(self)
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    @property
+    def returncode(self):
+        return self._process.returncode
+
+    def poll(self):
+        returncode = self._process.poll()
+        if returncode is not None:
+            with _live_lock:
+                _live_processes.discard(self)
+        return returncode
+
+    def wait(self, timeout=None, stop_event=None):
+        """
+        Wait for the process to exit and return its exit code, or None if
+        it is still running after timeout seconds or stop_event is set.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.time() >= deadline:
+                return None
+            if stop_event is not None and stop_event.is_set():
+                return None
+            time.sleep(POLL_INTERVAL)
+        return self.returncode
+
+    def stop(self, grace=5.0):
+        if self.poll() is not None:
+            return self.returncode
+        try:
+            self._process.terminate()
+            if self.wait(grace) is None:
+                self._process.kill()
+                self._process.wait()
+        except OSError:
+            pass
+        self.poll()
+        return self.returncode
+
+
+class CaptureSlot(object):
+    """
+    The resources one capture runs on: a NIC, a set of cores and its own
+    pair of DADA ring buffers.
+    """
+    def __init__(self, index, interface, cores, input_key, output_key, buffer_pool=None):
+        self.index = index
+        self.interface = interface
+        self.cores = cores
+        self.input_key = input_key
+        self.output_key = output_key
+        self.pool = buffer_pool or DadaBufferPool([DadaBuffer(input_key),DadaBuffer(output_key)])
+
+def make_slots(interfaces, cores, **kwargs):
+    """
+    Make one slot per (interface, cores) pair, giving each its own ring
+    keys. Consecutive keys are 2 apart as each ring also uses key+1 for its
+    header block.
+    """
+    slots = []
+    for index,(interface,slot_cores) in enumerate(zip(interfaces,cores)):
+        slots.append(CaptureSlot(index,interface,slot_cores,
+            "%04x"%(0xdada+2*index),"%04x"%(0xcaca+2*index),**kwargs))
+    return slots
+
+
+def udp2db_options(slot):
+    """
+    Return the udp2db options for the ring key and capture interface of a
+    slot, leaving out those at the udp2db defaults.
+    """
+    options = ""
+    if slot.input_key != UDP2DB_DEFAULT_KEY:
+        options += " -k {}".format(slot.input_key)
+    if slot.interface:
+        options += " -i {}".format(slot.interface)
+    return options
+
+
+class GroupCapture(object):
+    """
+    Captures one multicast group into out_path on a slot.
+
+    dada_dbdisk and feng2dada are started first and udp2db is then run
+    for up to timeout seconds. Once udp2db has exited the downstream
+    stages are given drain_timeout seconds to finish the ring before they
+    are stopped. Every process is stopped, whatever happens, before run()
+    returns a summary of the exit codes and of the ring and disk telemetry,
+    which is also written to out_path/monitor_NN.jsonl.
+    """
+    def __init__(self, group_id, filter_id, out_path, tobs, slot,
+            commands=COMMANDS, environment=ENVIRONMENT, make_header=make_header,
+            timeout=None, drain_timeout=10.0, monitor_interval=MONITOR_INTERVAL):
+        self.group_id = group_id
+        self.filter_id = filter_id
+        self.out_path = out_path
+        self.tobs = tobs
+        self.slot = slot
+        self._commands = commands
+        self._environment = environment
+        self._make_header = make_header
+        self._timeout = timeout
+        self._drain_timeout = drain_timeout
+        self._monitor_interval = monitor_interval
+
+    def _start(self, stage, params, log):
+        cmd = self._commands[stage].format(**params)
+        return ManagedProcess(stage,cmd,self._environment.get(stage),log)
+
+    def run(self, stop_event=None):
+        slot = self.slot
+        header = os.path.join(self.out_path,"header_{:02d}.txt".format(self.group_id))
+        params = {
+            "group": MULTICAST_BASE.format(150+self.group_id),
+            "header": header,
+            "tobs": self.tobs,
+            "out_path": self.out_path,
+            "interface": slot.interface,
+            "cores": slot.cores,
+            "input_key": slot.input_key,
+            "output_key": slot.output_key,
+            "udp2db_options": udp2db_options(slot)
+            }
+        result = {"group_id":self.group_id, "slot":slot.index, "status":"ok", "returncodes":{}}
+        processes = []
+        monitor = CaptureMonitor(slot.pool,monitored_rings(slot.pool),
+            self.out_path,self._monitor_interval)
+        start = time.time()
+        log = open(os.path.join(self.out_path,"capture_{:02d}.log".format(self.group_id)),"a")
+        try:
+            slot.pool.reset()
+            self._make_header(self.group_id,self.filter_id,header)
+            for stage in ("dada_dbdisk","feng2dada"):
+                processes.append(self._start(stage,params,log))
+            udp2db = self._start("udp2db",params,log)
+            processes.append(udp2db)
+            monitor.start()
+            if udp2db.wait(self._timeout,stop_event) is None:
+                result["status"] = "cancelled" if stop_event is not None and stop_event.is_set() else "timeout"
+            elif udp2db.returncode != 0:
+                result["status"] = "failed"
+            if result["status"] == "ok":
+                deadline = time.time() + self._drain_timeout
+                for process in processes[:-1]:
+                    if process.wait(max(deadline-time.time(),0),stop_event) not in (None,0):
+                        result["status"] = "failed"
+        except Exception as error:
+            result["status"] = "error"
+            result["error"] = str(error)
+        finally:
+            monitor.stop()
+            for process in reversed(processes):
+                process.stop()
+                result["returncodes"][process.name] = process.returncode
+            log.close()
+        result["seconds"] = time.time() - start
+        monitor.dump(os.path.join(self.out_path,"monitor_{:02d}.jsonl".format(self.group_id)))
+        result["monitor"] = monitor.summary()
+        return result
+
+
+class CaptureScheduler(object):
+    """
+    Runs group captures concurrently, at most one per slot.
+
+    make_capture(group_id, slot) returns the GroupCapture for a group; a
+    slot takes the next waiting group as soon as its last capture has been
+    cleaned up.
+    """
+    def __init__(self, slots, make_capture):
+        self.slots = slots
+        self._make_capture = make_capture
+        self._stop = threading.Event()
+
+    def _work(self, slot, groups, results):
+        while not self._stop.is_set():
+            try:
+                group_id = groups.get_nowait()
+            except Queue.Empty:
+                return
+            results.append(self._make_capture(group_id,slot).run(self._stop))
+
+    def run(self, group_ids):
+        """
+        Capture every group and return the results in group order.
+        """
+        groups = Queue.Queue()
+        for group_id in group_ids:
+            groups.put(group_id)
+        results = []
+        threads = [threading.Thread(target=self._work,args=(slot,groups,results)) for slot in self.slots]
+        for thread in threads:
+            thread.start()
+        try:
+            # Join with a timeout so that Ctrl-C still reaches the main thread
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+        return sorted(results,key=lambda result: result["group_id"])
+
+    def stop(self):
+        self._stop.set()
+
+
+def cycle_capture(filter_id, tobs, base_path, slots, group_ids=range(NGROUPS), **kwargs):
+    """
+    Capture the groups into base_path/group_NN, len(slots) at a time.
+    """
+    def make_capture(group_id, slot):
+        out_path = os.path.join(base_path,"group_%02d"%(group_id))
+        if not os.path.isdir(out_path):
+            os.makedirs(out_path)
+        return GroupCapture(group_id,filter_id,out_path,tobs,slot,**kwargs)
+    for slot in slots:
+        slot.pool.ensure()
+    return CaptureScheduler(slots,make_capture).run(group_ids)
+
+def make_parser():
+    usage = "usage: {prog} [options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-f','--filter_id', dest='filter_id', type=int, required=True,
+        help='The filter id passed to the header maker.')
+    required.add_argument('-t','--tobs', dest='tobs', type=float, required=True,
+        help='The length of each group capture in seconds.')
+    required.add_argument('-o','--base_path', dest='base_path', type=str, required=True,
+        help='The directory to write the group_NN output directories to.')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-i','--interfaces', dest='interfaces', type=str,
+        default="", help='Comma separated capture interfaces, one slot each.')
+    optional.add_argument('-c','--cores', dest='cores', type=str,
+        default="", help='Semicolon separated core lists for the slots, e.g. "0-3;4-7".')
+    optional.add_argument('-g','--groups', dest='groups', type=str,
+        default=None, help='Comma separated group ids to capture. Default is all {}.'.format(NGROUPS))
+    optional.add_argument('--timeout', dest='timeout', type=float,
+        default=None, help='Seconds after which a capture is stopped. Default is tobs plus 60 seconds.')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    interfaces = opts.interfaces.split(",")
+    cores = opts.cores.split(";") if opts.cores else ["0-{}".format(os.sysconf("SC_NPROCESSORS_ONLN")-1)]*len(interfaces)
+    if len(cores) != len(interfaces):
+        raise ValueError("Give one core list per interface")
+    group_ids = range(NGROUPS) if opts.groups is None else [int(group) for group in opts.groups.split(",")]
+    timeout = opts.tobs + 60 if opts.timeout is None else opts.timeout
+    results = cycle_capture(opts.filter_id,opts.tobs,opts.base_path,make_slots(interfaces,cores),
+        group_ids,timeout=timeout)
+    for result in results:
+        print "group {group_id:02d} slot {slot} {status:<9} {seconds:7.1f} s {returncodes}".format(**result)
+    if any(result["status"] != "ok" for result in results):
+        sys.exit(1)
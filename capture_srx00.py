@@ -1,45 +1,118 @@
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 import os
+import sys
+from dada_header import make_header
+from dada_buffers import DadaBuffer, DadaBufferPool
+from pipeline_worker import WarmPipeline
+from capture_monitor import CaptureMonitor, OutputDrain, MONITOR_INTERVAL, monitored_rings
 
 FENG2DADA = "/home/pulsar/soft/psrdada_cpp/build/psrdada_cpp/meerkat/tools/feng2dada"
 UDPDB = "/home/pulsar/soft/psrdada/asterix/udp2db"
-HEADER_MAKER = "/home/pulsar/scripts/freq_calc.py"
-HEADER = "/tmp/header.txt"
+
+# The rings are created once and reused by every capture
+DADA_BUFFERS = [DadaBuffer("dada"), DadaBuffer("caca")]
+
+# The tools here run straight on the host, so the stage workers are local
+# processes and a warm capture still starts every stage process; it only
+# saves starting the workers. capture.WORKER_RUNTIME runs them in
+# containers that stay up between captures.
+WORKER_RUNTIME = sys.executable + " {worker} --socket {socket}"
+PIPELINE_STAGES = ("dada_dbdisk", "feng2dada", "udp2db")
+DRAIN_TIMEOUT = 5.0
 
 def make_dada_key_string(key):
     return "DADA INFO:\nkey {0}".format(key)
 
-def reset_dada_buffers():
-    os.system("dada_db -d")
-    os.system("dada_db -n 20 -b 209715200 -l -p")
-    os.system("dada_db -d -k caca")
-    os.system("dada_db -k caca -n 20 -b 209715200 -l -p")
+def make_buffer_pool():
+    pool = DadaBufferPool(DADA_BUFFERS)
+    pool.ensure()
+    return pool
 
-def make_header(group_id, filter_id):
-    cmd = "python {} -a 4 -g {} -f {} -d > {}".format(
-        HEADER_MAKER, group_id, filter_id, HEADER)
-    os.system(cmd)
+def capture(group_id, filter_id, out_path, tobs, pool=None, monitor_interval=MONITOR_INTERVAL):
+    """
+    Capture one group, draining the output of every stage into
+    out_path/capture.log and sampling ring occupancy and disk throughput
+    into out_path/monitor_NN.jsonl. Returns the CaptureMonitor.
+    """
+    group = "239.2.1.{}".format(150+group_id)
+    pool = make_buffer_pool() if pool is None else pool
+    pool.reset()
+    header = make_header(group_id, filter_id)
+    log = open(os.path.join(out_path, "capture.log"), "a")
+    monitor = CaptureMonitor(pool, monitored_rings(pool), out_path, monitor_interval)
+    # exec so that kill() reaches the stage rather than its shell
+    cmd = "exec dada_dbdisk -D {} -k caca".format(out_path)
+    dada_dbdisk = Popen([cmd], stdout=PIPE, stderr=STDOUT, shell=True)
+    cmd = "exec {} -i dada -o caca -c 256".format(FENG2DADA)
+    feng2dada = Popen([cmd], stdout=PIPE, stderr=STDOUT, shell=True)
+    cmd = "LD_PRELOAD=libvma.so exec {} -s {} -p 7148 -m {} -H {}".format(
+        UDPDB, tobs, group, header)
+    udp2db = Popen([cmd], stdout=PIPE, stderr=STDOUT, shell=True)
+    drains = [OutputDrain("dada_dbdisk", dada_dbdisk.stdout, log),
+        OutputDrain("feng2dada", feng2dada.stdout, log),
+        OutputDrain("udp2db", udp2db.stdout, log)]
+    monitor.start()
+    try:
+        udp2db.wait()
+    finally:
+        monitor.stop()
+        for process in (udp2db, dada_dbdisk, feng2dada):
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        for drain in drains:
+            # A stage's own children may keep its pipe open after it is killed
+            drain.join(DRAIN_TIMEOUT)
+        log.close()
+        os.remove(header)
+    monitor.dump(os.path.join(out_path, "monitor_{:02d}.jsonl".format(group_id)))
+    summary = monitor.summary()
+    print "group {:02d}: peak ring fill {}, {} alerts".format(group_id, summary["peak_fill"], len(summary["alerts"]))
+    return monitor
 
-def capture(group_id, filter_id, out_path, tobs):
+def start_pipeline(runtime=WORKER_RUNTIME):
+    pipeline = WarmPipeline(PIPELINE_STAGES, runtime)
+    for stage, seconds in sorted(pipeline.start().items()):
+        print "{} worker ready after {:.2f} s".format(stage, seconds)
+    return pipeline
+
+def capture_warm(pipeline, group_id, filter_id, out_path, tobs, pool, monitor_interval=MONITOR_INTERVAL):
     group = "239.2.1.{}".format(150+group_id)
-    reset_dada_buffers()
-    make_header(group_id, filter_id)
-    cmd = "dada_dbdisk -D {} -k caca".format(out_path)
-    dada_dbdisk = Popen([cmd], stdout=PIPE, stderr=PIPE, shell=True)
-    cmd = "{} -i dada -o caca -c 256".format(FENG2DADA)
-    feng2dada = Popen([cmd], stdout=PIPE, stderr=PIPE, shell=True)
-    cmd = "LD_PRELOAD=libvma.so {} -s {} -p 7148 -m {} -H {}".format(
-        UDPDB, tobs, group, HEADER)
-    os.system(cmd)
-    dada_dbdisk.kill()
-    feng2dada.kill()
-
-def cycle_capture(filter_id, tobs, base_path):
-    for group_id in range(16):
-        out_path = os.path.join(base_path,"group_%02d"%(group_id))
-        try:
-            os.mkdir(out_path)
-        except Exception as error:
-            print error
-        capture(group_id, filter_id, out_path, tobs)
+    pool.reset()
+    header = make_header(group_id, filter_id)
+    log = os.path.join(out_path, "capture.log")
+    monitor = CaptureMonitor(pool, monitored_rings(pool), out_path, monitor_interval)
+    try:
+        pipeline.run("dada_dbdisk", "dada_dbdisk -D {} -k caca".format(out_path), log=log)
+        pipeline.run("feng2dada", "{} -i dada -o caca -c 256".format(FENG2DADA), log=log)
+        cmd = "{} -s {} -p 7148 -m {} -H {}".format(UDPDB, tobs, group, header)
+        pipeline.run("udp2db", cmd, env={"LD_PRELOAD": "libvma.so"}, log=log)
+        monitor.start()
+        pipeline.wait("udp2db")
+    finally:
+        monitor.stop()
+        # A stage left running on its worker would break the next group
+        for stage in ("udp2db", "feng2dada", "dada_dbdisk"):
+            pipeline.stop(stage)
+        os.remove(header)
+    monitor.dump(os.path.join(out_path, "monitor_{:02d}.jsonl".format(group_id)))
+    return monitor
+
+def cycle_capture(filter_id, tobs, base_path, warm=False, runtime=WORKER_RUNTIME):
+    pool = make_buffer_pool()
+    pipeline = start_pipeline(runtime) if warm else None
+    try:
+        for group_id in range(16):
+            out_path = os.path.join(base_path,"group_%02d"%(group_id))
+            try:
+                os.mkdir(out_path)
+            except Exception as error:
+                print error
+            if pipeline is not None:
+                capture_warm(pipeline, group_id, filter_id, out_path, tobs, pool)
+            else:
+                capture(group_id, filter_id, out_path, tobs, pool=pool)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
 
@@ -0,0 +1,133 @@
+import json
+import os
+import subprocess
+
+STATE_DIR = "/tmp"
+# Data block counters printed by dada_dbmetric, in order
+METRIC_FIELDS = ("nbufs","full","clear","written","read")
+
+class DadaBufferError(Exception):
+    pass
+
+
+class DadaBuffer(object):
+    """
+    The geometry of one PSRDADA ring buffer.
+    """
+    def __init__(self, key, nbufs=20, bufsz=209715200, lock=True, page=True):
+        self.key = key
+        self.nbufs = nbufs
+        self.bufsz = bufsz
+        self.lock = lock
+        self.page = page
+
+    def geometry(self):
+        return {"nbufs":self.nbufs, "bufsz":self.bufsz, "lock":self.lock, "page":self.page}
+
+    def create_args(self):
+        args = "-k {} -n {} -b {}".format(self.key,self.nbufs,self.bufsz)
+        if self.lock:
+            args += " -l"
+        if self.page:
+            args += " -p"
+        return args
+
+
+class DadaBufferPool(object):
+    """
+    Keeps a set of PSRDADA ring buffers alive across captures.
+
+    ensure() creates each ring once and only destroys and recreates it if
+    the geometry recorded when it was created differs from the one asked
+    for. Between captures reset() scrubs the rings, clearing their read and
+    write state, instead of reallocating the locked shared memory.
+
+    Commands are built from the tools in bin_dir (found on the PATH if
+    empty) and passed through the wrapper template, e.g. a docker run
+    command with a {} for the tool, so a stand-in dada_db can be used.
+    """
+    def __init__(self, buffers, wrapper="{}", bin_dir="", state_dir=STATE_DIR):
+        self.buffers = buffers
+        self._wrapper = wrapper
+        self._bin_dir = bin_dir
+        self._state_dir = state_dir
+
+    def _run(self, tool, args):
+        cmd = self._wrapper.format("{} {}".format(os.path.join(self._bin_dir,tool),args))
+        with open(os.devnull,"w") as devnull:
+            return subprocess.call(cmd,shell=True,stdout=devnull,stderr=subprocess.STDOUT)
+
+    def _output(self, tool, args):
+        cmd = self._wrapper.format("{} {}".format(os.path.join(self._bin_dir,tool),args))
+        process = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return process.returncode,output
+
+    def _state_file(self, buf):
+        return os.path.join(self._state_dir,"dada_buffer_{}.json".format(buf.key))
+
+    def _recorded_geometry(self, buf):
+        try:
+            with open(self._state_file(buf)) as f:
+                return json.load(f)
+        except (IOError,ValueError):
+            return None
+
+    def exists(self, buf):
+        return self._run("dada_dbmetric","-k {}".format(buf.key)) == 0
+
+    def metrics(self, buf):
+        """
+        Return the data block counters of a ring, as reported by
+        dada_dbmetric, as a dict keyed by METRIC_FIELDS, or None if the ring
+        cannot be read.
+        """
+        returncode,output = self._output("dada_dbmetric","-k {}".format(buf.key))
+        if returncode != 0:
+            return None
+        for line in output.splitlines():
+            fields = line.strip().split(",")
+            if len(fields) >= len(METRIC_FIELDS) and all(field.isdigit() for field in fields[:len(METRIC_FIELDS)]):
+                return dict(zip(METRIC_FIELDS,[int(field) for field in fields]))
+        return None
+
+    def ensure(self):
+        """
+        Make sure every ring exists with the requested geometry.
+
+        Returns the keys of the rings that had to be (re)created.
+        """
+        created = []
+        for buf in self.buffers:
+            if self.exists(buf):
+                if self._recorded_geometry(buf) == buf.geometry():
+                    continue
+                self.destroy(buf)
+            if self._run("dada_db",buf.create_args()) != 0:
+                raise DadaBufferError("Could not create DADA buffer {}".format(buf.key))
+            with open(self._state_file(buf),"w") as f:
+                json.dump(buf.geometry(),f)
+            created.append(buf.key)
+        return created
+
+    def reset(self):
+        """
+        Clear the read/write state and contents of every ring.
+
+        A ring that cannot be scrubbed, e.g. because it has gone away since
+        the pool was made, is recreated by ensure() and scrubbed again.
+        """
+        for buf in self.buffers:
+            if self._run("dada_dbscrubber","-k {}".format(buf.key)) == 0:
+                continue
+            self.ensure()
+            if self._run("dada_dbscrubber","-k {}".format(buf.key)) != 0:
+                raise DadaBufferError("Could not reset DADA buffer {}".format(buf.key))
+
+    def destroy(self, buf=None):
+        for buf in self.buffers if buf is None else [buf]:
+            self._run("dada_db","-d -k {}".format(buf.key))
+            try:
+                os.remove(self._state_file(buf))
+            except OSError:
+                pass
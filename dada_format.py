@@ -0,0 +1,15 @@
+import zlib
+import numpy as np
+
+# The compressed DADA file format, written by pcap_to_dada and read by
+# fringe_finder. Each codec is a (compress(data, level), decompress(data))
+# pair.
+COMPRESSION_CODECS = {
+    "zlib": (zlib.compress, zlib.decompress)
+    }
+# One entry per compressed chunk, stored after the header of compressed files
+CHUNK_INDEX_DTYPE = np.dtype([
+    ("offset","<u8"),
+    ("size","<u4"),
+    ("nbytes","<u4")
+    ])
@@ -0,0 +1,83 @@
+import os
+import tempfile
+from astropy.time import Time
+from pcap_to_dada import render_dada_header
+
+NGROUPS = 16
+NCHAN_TOTAL = 4096
+HEADER_DIR = "/tmp"
+
+# Receiver band of each filter id: (receiver name, centre frequency and bandwidth in MHz)
+FILTERS = {
+    0: ("lband", 1284.0, 856.0),
+    1: ("uhf", 816.0, 544.0)
+}
+
+def group_header_fields(group_id, filter_id, ngroups=NGROUPS, nchan_total=NCHAN_TOTAL):
+    """
+    Return the DADA header fields describing the channels of one multicast
+    group, the group_id'th of ngroups equal slices of the band.
+    """
+    receiver, cfreq, bandwidth = FILTERS[filter_id]
+    nchan = nchan_total // ngroups
+    chbw = bandwidth / nchan_total
+    return {
+        "receiver_name": receiver,
+        "nchan": nchan,
+        "bandwidth": nchan * chbw,
+        "frequency_mhz": cfreq - bandwidth/2 + chbw * (group_id * nchan + nchan/2.0),
+        "tsamp": 1 / chbw
+    }
+
+
+class HeaderService(object):
+    """
+    Renders the DADA headers of every group of a filter in-process.
+
+    The headers of all groups are rendered once up front. write() puts a
+    copy in a file of its own for each capture, so captures running at the
+    same time never share a header file.
+    """
+    def __init__(self, filter_id, header_dir=None, ngroups=NGROUPS, sync_epoch=None, **overrides):
+        self.filter_id = filter_id
+        self._header_dir = header_dir
+        fields = dict(overrides)
+        if sync_epoch is not None:
+            t = Time(sync_epoch, format="unix", scale="utc", precision=9)
+            fields["utc_start"] = t.iso.replace(" ", "-")
+            fields["mjd"] = t.mjd
+        self._headers = []
+        for group_id in range(ngroups):
+            group_fields = group_header_fields(group_id, filter_id, ngroups)
+            group_fields.update(fields)
+            self._headers.append(render_dada_header(group_fields))
+
+    def header(self, group_id):
+        return self._headers[group_id]
+
+    def write(self, group_id, path=None):
+        """
+        Write the header of a group to path, or to a new uniquely named
+        file if no path is given, and return the path.
+        """
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="header_{:02d}_".format(group_id),
+                suffix=".txt", dir=self._header_dir)
+            f = os.fdopen(fd, "w")
+        else:
+            f = open(path, "w")
+        with f:
+            f.write(self._headers[group_id])
+        return path
+
+
+_header_services = {}
+
+def make_header(group_id, filter_id, header=None):
+    """
+    Write the DADA header of a group and return its path. Unless a path is
+    given every call writes a new file, so captures can run side by side.
+    """
+    if filter_id not in _header_services:
+        _header_services[filter_id] = HeaderService(filter_id, HEADER_DIR)
+    return _header_services[filter_id].write(group_id, header)
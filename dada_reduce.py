@@ -0,0 +1,158 @@
+import struct
+import sys
+import datetime
+import numpy as np
+from argparse import ArgumentParser
+from fringe_finder import open_streams
+
+MJD_EPOCH = datetime.datetime(1858,11,17)
+STOKES_PARAMETERS = ("I","IQUV")
+
+def sigproc_header(params):
+    """
+    Pack a SIGPROC filterbank header from (keyword, value) pairs.
+    """
+    def pack_string(value):
+        return struct.pack("<i",len(value)) + value
+    header = pack_string("HEADER_START")
+    for key,value in params:
+        header += pack_string(key)
+        if isinstance(value,str):
+            header += pack_string(value)
+        elif isinstance(value,int):
+            header += struct.pack("<i",value)
+        else:
+            header += struct.pack("<d",value)
+    return header + pack_string("HEADER_END")
+
+def mjd(utc):
+    if utc.tzinfo is not None:
+        utc = utc.replace(tzinfo=None) - utc.utcoffset()
+    return (utc - MJD_EPOCH).total_seconds() / 86400.0
+
+
+class PowerReducer(object):
+    """
+    Detects and decimates the voltages of a DadaFileStream.
+
+    Voltages are read block by block in their native integer type, detected
+    to Stokes I or full Stokes (I, Q, U, V) and summed over tscrunch samples
+    and fscrunch channels in integer arithmetic, so memory use is set by the
+    block size rather than the length of the observation. Output powers are
+    float32 means with shape (nsamps, nifs, nchan), the SIGPROC order. Full
+    Stokes uses I = XX+YY, Q = XX-YY, U = 2Re(XY*) and V = -2Im(XY*).
+    """
+    def __init__(self, stream, tscrunch=1, fscrunch=1, stokes="I", block_size=16384):
+        layout = stream.layout
+        if stokes not in STOKES_PARAMETERS:
+            raise ValueError("Stokes must be one of {}".format(STOKES_PARAMETERS))
+        if stokes == "IQUV" and (layout.npol != 2 or layout.ndim != 2):
+            raise ValueError("Full Stokes needs two complex polarisations")
+        if layout.nchan % fscrunch:
+            raise ValueError("fscrunch must divide the {} channels".format(layout.nchan))
+        self._stream = stream
+        self.tscrunch = tscrunch
+        self.fscrunch = fscrunch
+        self.stokes = stokes
+        self.nifs = len(stokes)
+        self.nchan = layout.nchan // fscrunch
+        self.block_size = max(block_size // tscrunch,1) * tscrunch
+        # Squares of 16-bit values overflow 32-bit sums
+        self._work_dtype = np.dtype("int64" if layout.nbit == 16 else "int32")
+
+    def _detect(self, raw):
+        # (nsamps, nchan, npol, ndim) voltages -> (nsamps, nifs, nchan) powers
+        v = raw.astype(self._work_dtype)
+        if self.stokes == "I":
+            return np.einsum("ijkl,ijkl->ij",v,v)[:,None,:]
+        x,y = v[:,:,0],v[:,:,1]
+        xx = np.einsum("ijl,ijl->ij",x,x)
+        yy = np.einsum("ijl,ijl->ij",y,y)
+        power = np.empty((v.shape[0],4,v.shape[1]),dtype=self._work_dtype)
+        power[:,0] = xx + yy
+        power[:,1] = xx - yy
+        power[:,2] = 2 * np.einsum("ijl,ijl->ij",x,y)
+        power[:,3] = 2 * (x[...,0]*y[...,1] - x[...,1]*y[...,0])
+        return power
+
+    def _decimate(self, power):
+        nsamps = power.shape[0] // self.tscrunch
+        power = power[:nsamps*self.tscrunch].reshape(nsamps,self.tscrunch,self.nifs,self.nchan,self.fscrunch)
+        total = power.sum(axis=(1,4),dtype="int64")
+        return (total / float(self.tscrunch * self.fscrunch)).astype("float32")
+
+    def nsamps(self, start=0, count=None):
+        count = self._stream.nsamps - start if count is None else count
+        return count // self.tscrunch
+
+    def blocks(self, start=0, count=None):
+        """
+        Yield reduced blocks of (nsamps, nifs, nchan) float32 powers.
+
+        Samples left over after the last whole tscrunch bin are dropped.
+        """
+        count = self.nsamps(start,count) * self.tscrunch
+        for raw in self._stream.iter_blocks(self.block_size,start=start,count=count,raw=True):
+            yield self._decimate(self._detect(raw))
+
+    def filterbank_header(self, start=0):
+        header = self._stream.header
+        foff = header["BW"] / self._stream.layout.nchan * self.fscrunch
+        tsamp = header["TSAMP"] * 1e-6
+        start_seconds = (self._stream.start_sample + start) * tsamp
+        return sigproc_header([
+            ("source_name",header.get("SOURCE","unknown")),
+            ("data_type",1),
+            ("fch1",header["FREQ"] - header["BW"]/2.0 + foff/2.0),
+            ("foff",foff),
+            ("nchans",self.nchan),
+            ("nbits",32),
+            ("nifs",self.nifs),
+            ("tstart",mjd(header["UTC_START"]) + start_seconds/86400.0),
+            ("tsamp",tsamp * self.tscrunch)
+            ])
+
+    def write(self, fname, start=0, count=None):
+        """
+        Write the reduced data to a SIGPROC filterbank file, block by block.
+
+        Returns the number of output samples written.
+        """
+        nsamps = 0
+        with open(fname,"wb") as f:
+            f.write(self.filterbank_header(start))
+            for block in self.blocks(start,count):
+                block.tofile(f)
+                nsamps += block.shape[0]
+        return nsamps
+
+
+def make_parser():
+    usage = "usage: {prog} [options] filestem".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('filestem', type=str,
+        help='The DADA file stem to reduce, e.g. obs_00_01024')
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-o','--output', dest='output', type=str, required=True,
+        help='The filterbank file to write.')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-t','--tscrunch', dest='tscrunch', type=int,
+        default=1, help='The number of samples to average (default is 1).')
+    optional.add_argument('-f','--fscrunch', dest='fscrunch', type=int,
+        default=1, help='The number of channels to average (default is 1).')
+    optional.add_argument('--stokes', dest='stokes', type=str, choices=STOKES_PARAMETERS,
+        default="I", help='Write Stokes I or full Stokes IQUV (default is I).')
+    optional.add_argument('-s','--start', dest='start', type=int,
+        default=0, help='The first sample to reduce (default is 0).')
+    optional.add_argument('-n','--count', dest='count', type=int,
+        default=None, help='The number of samples to reduce. Default is all of them.')
+    optional.add_argument('-b','--block_size', dest='block_size', type=int,
+        default=16384, help='The number of samples read at a time (default is 16384).')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    stream = open_streams([opts.filestem])[0]
+    reducer = PowerReducer(stream,opts.tscrunch,opts.fscrunch,opts.stokes,opts.block_size)
+    nsamps = reducer.write(opts.output,opts.start,opts.count)
+    print "Wrote {} samples of {} channels to {}".format(nsamps,reducer.nchan,opts.output)
@@ -1,8 +1,26 @@
 import glob
+import os
+import sys
+import threading
+import itertools
+import multiprocessing
+import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from argparse import ArgumentParser
 from dateutil import parser
+from dada_format import COMPRESSION_CODECS, CHUNK_INDEX_DTYPE
 
 HEADER_SIZE = 4096
+# Files each stream keeps mapped, enough for a block and the prefetched one
+MAX_OPEN_MAPS = 4
+# Samples the correlator reads at a time, whatever the integration length
+READ_SIZE = 256
+NCHAN = 256
+NPOL = 2
+DADA_SUFFIX = ".dada"
+CATALOG_FILENAME = ".dada_catalog.npy"
 
 HEADER_PARSER = {
     "FILE_SIZE":int,
@@ -10,54 +28,908 @@ HEADER_PARSER = {
     "NBIT":int,
     "NDIM":int,
     "NPOL":int,
-    "NCHAN":int
+    "NCHAN":int,
+    "FREQ":float,
+    "BW":float,
+    "TSAMP":float,
+    "OBS_OFFSET":int,
+    "HDR_SIZE":int,
+    "COMPRESSION":str,
+    "CHUNK_SIZE":int,
+    "NCHUNKS":int
 }
 
+CATALOG_DTYPE = np.dtype([
+    ("fname","S256"),
+    ("mtime","float64"),
+    ("size","int64"),
+    ("nsamps","int64"),
+    ("header","S1024")
+    ])
+
+FRINGE_DTYPE = np.dtype([
+    ("ant1","int32"),
+    ("ant2","int32"),
+    ("delay","float64"),
+    ("rate","float64"),
+    ("snr","float64")
+    ])
+
+def prefetch(blocks, fill, buffers):
+    """
+    Fill blocks on a background thread, one block ahead of the consumer.
+
+    fill(block, buffer) writes one block into a buffer and returns the
+    filled view. Views are yielded in order and each is only valid until
+    the next one is requested. With two buffers this double-buffers I/O
+    against the caller's processing.
+    """
+    free = Queue.Queue()
+    ready = Queue.Queue()
+    stop = threading.Event()
+    for buf in buffers:
+        free.put(buf)
+
+    def run():
+        try:
+            for block in blocks:
+                buf = free.get()
+                if buf is None or stop.is_set():
+                    return
+                ready.put((buf,fill(block,buf),None))
+        except Exception as error:
+            ready.put((None,None,error))
+            return
+        ready.put(None)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            buf,view,error = item
+            if error is not None:
+                raise error
+            yield view
+            free.put(buf)
+    finally:
+        stop.set()
+        free.put(None)
+        thread.join()
+
+
+class DadaLayout(object):
+    """
+    Sample layout of a DADA stream, taken from its header.
+
+    Samples are (nchan, npol, ndim) values of NBIT bits each. 4-bit values
+    are packed two to a byte, low nibble first, and unpacked to int8; 8 and
+    16-bit values are read as int8 and little-endian int16. Files with a
+    COMPRESSION codec hold their data as NCHUNKS compressed chunks, see
+    CompressedDadaMap.
+    """
+    def __init__(self, header):
+        self.nchan = header.get("NCHAN",NCHAN)
+        self.npol = header.get("NPOL",NPOL)
+        self.ndim = header.get("NDIM",2)
+        self.nbit = header.get("NBIT",8)
+        if self.nbit not in (4,8,16):
+            raise ValueError("Unsupported NBIT {}".format(self.nbit))
+        self.header_size = header.get("HDR_SIZE",HEADER_SIZE)
+        self.compression = header.get("COMPRESSION")
+        if self.compression is not None and self.compression not in COMPRESSION_CODECS:
+            raise ValueError("Unsupported COMPRESSION {}".format(self.compression))
+        self.nchunks = header.get("NCHUNKS",0)
+        self.shape = (self.nchan,self.npol,self.ndim)
+        self.dtype = np.dtype("<i2" if self.nbit == 16 else "int8")
+        self.bytes_per_sample = self.nchan * self.npol * self.ndim * self.nbit // 8
+
+    def file_nsamps(self, fname, size=None):
+        """
+        Return the number of samples in a file with this layout.
+        """
+        if self.compression is not None:
+            return int(read_chunk_index(fname,self)["nbytes"].sum()) // self.bytes_per_sample
+        size = os.path.getsize(fname) if size is None else size
+        return max(size - self.header_size,0) // self.bytes_per_sample
+
+    def unpack(self, data):
+        """
+        Return the values of (nsamps, bytes_per_sample) raw bytes as
+        (nsamps, nchan, npol, ndim). This is a view unless NBIT is 4.
+        """
+        nsamps = data.shape[0]
+        if self.nbit == 4:
+            values = np.empty((nsamps,data.shape[1],2),dtype="int8")
+            values[...,0] = (data << 4) >> 4
+            values[...,1] = data >> 4
+            return values.reshape((nsamps,)+self.shape)
+        return data.view(self.dtype).reshape((nsamps,)+self.shape)
+
+
+class DadaSegment(object):
+    """
+    Lazy view of a range of samples that may span several files.
+
+    The segment holds byte views of the memory-mapped files, so nothing is
+    read from disk until the data are converted.
+    """
+    def __init__(self, parts, layout):
+        self._parts = parts
+        self.layout = layout
+        self.nsamps = sum(part.shape[0] for part in parts)
+
+    def __len__(self):
+        return self.nsamps
+
+    def slice(self, start, count):
+        parts = []
+        for part in self._parts:
+            if count <= 0:
+                break
+            if start < part.shape[0]:
+                parts.append(part[start:start+count])
+                count -= parts[-1].shape[0]
+                start = 0
+            else:
+                start -= part.shape[0]
+        return DadaSegment(parts,self.layout)
+
+    def raw(self, out=None, chan_range=None):
+        """
+        Return the voltages as (nsamps, nchan, npol, ndim) in the layout dtype,
+        only of the channels in chan_range if given.
+
+        This is a view unless the segment spans more than one file, the
+        data are 4-bit or an output buffer is given. Only the selected
+        channels of 8 and 16-bit data are copied.
+        """
+        chans = slice(None) if chan_range is None else slice(*chan_range)
+        if out is None and len(self._parts) == 1:
+            return self.layout.unpack(self._parts[0])[:,chans]
+        if out is None:
+            nchan = len(range(self.layout.nchan)[chans])
+            out = np.empty((self.nsamps,nchan)+self.layout.shape[1:],dtype=self.layout.dtype)
+        pos = 0
+        for part in self._parts:
+            nsamps = part.shape[0]
+            out[pos:pos+nsamps] = self.layout.unpack(part)[:,chans]
+            pos += nsamps
+        return out
+
+    def to_complex(self, out=None):
+        """
+        Convert the voltages to complex64 as (nsamps, nchan, npol).
+
+        Real (NDIM 1) data get a zero imaginary part. The result is written
+        into out if given, which must be C-contiguous.
+        """
+        layout = self.layout
+        shape = (self.nsamps,layout.nchan,layout.npol)
+        if out is None:
+            out = np.empty(shape,dtype="complex64")
+        if out.shape != shape or out.dtype != np.complex64:
+            raise ValueError("Output buffer must be complex64 with shape {}".format(shape))
+        if not out.flags.c_contiguous:
+            raise ValueError("Output buffer must be C-contiguous")
+        pos = 0
+        for part in self._parts:
+            nsamps = part.shape[0]
+            dest = out[pos:pos+nsamps].view("float32").reshape(nsamps,layout.nchan,layout.npol,2)
+            dest[...,:layout.ndim] = layout.unpack(part)
+            if layout.ndim == 1:
+                dest[...,1] = 0
+            pos += nsamps
+        return out
+
+    def chunks(self, nsamps, out=None):
+        """
+        Yield the segment as complex64 blocks of at most nsamps samples.
+
+        All blocks share one buffer, so each is only valid until the next
+        one is produced.
+        """
+        if out is None:
+            out = np.empty((nsamps,self.layout.nchan,self.layout.npol),dtype="complex64")
+        for start in range(0,self.nsamps,nsamps):
+            count = min(nsamps,self.nsamps-start)
+            yield self.slice(start,count).to_complex(out[:count])
+
+
+def parse_header(text):
+    """
+    Parse the HEADER_PARSER keys out of the text of a DADA header.
+    """
+    header = {}
+    for line in text.splitlines():
+        try:
+            key = line.split()[0]
+            if key in HEADER_PARSER:
+                header[key] = HEADER_PARSER[key](line.split()[1])
+        except:
+            pass
+    return header
+
+def read_header(fname):
+    with open(fname,"r") as f:
+        return parse_header(f.read(HEADER_SIZE).split("\0",1)[0])
+
+def read_chunk_index(fname, layout):
+    """
+    Return the index entries of the chunks written to a compressed file.
+    """
+    with open(fname,"rb") as f:
+        f.seek(layout.header_size)
+        index = np.fromfile(f,dtype=CHUNK_INDEX_DTYPE,count=layout.nchunks)
+    return index[index["size"] > 0]
+
+
+_decompress_pools = {}
+_decompress_pid = None
+_decompress_lock = threading.Lock()
+
+def decompress_pool(nthreads):
+    """
+    Return the pool of nthreads threads that compressed streams share to
+    decompress chunks, so reading many antennas does not start a pool for
+    each. Pools are started on first use and again in forked children,
+    where the threads of the parent do not exist.
+    """
+    global _decompress_pid
+    with _decompress_lock:
+        if _decompress_pid != os.getpid():
+            _decompress_pools.clear()
+            _decompress_pid = os.getpid()
+        if nthreads not in _decompress_pools:
+            _decompress_pools[nthreads] = ThreadPool(nthreads)
+        return _decompress_pools[nthreads]
+
+
+class CompressedDadaMap(object):
+    """
+    Random access to the samples of a chunked, compressed DADA file.
+
+    Stands in for the memory map of an uncompressed file: slicing it
+    returns the (nsamps, bytes_per_sample) bytes of the requested samples,
+    decompressing only the chunks that overlap them, spread over the
+    threads of pool if given. Slices are copies, so the file is unmapped
+    as soon as the map itself is dropped.
+    """
+    def __init__(self, fname, layout, pool=None):
+        self.layout = layout
+        self._pool = pool
+        self._decompress = COMPRESSION_CODECS[layout.compression][1]
+        self._index = read_chunk_index(fname,layout)
+        self._first_byte = np.concatenate(([0],np.cumsum(self._index["nbytes"],dtype="int64")))
+        self._data = np.memmap(fname,dtype="uint8",mode="r")
+        self.shape = (int(self._first_byte[-1]) // layout.bytes_per_sample,layout.bytes_per_sample)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        start,stop,step = key.indices(self.shape[0])
+        if step != 1:
+            raise ValueError("Compressed files can only be read in contiguous ranges")
+        bytes_per_sample = self.layout.bytes_per_sample
+        first_byte = self._first_byte
+        lo,hi = start * bytes_per_sample,max(stop,start) * bytes_per_sample
+        out = np.empty(hi-lo,dtype="int8")
+        def fill(ii):
+            entry = self._index[ii]
+            offset = int(entry["offset"])
+            chunk = np.frombuffer(self._decompress(self._data[offset:offset+int(entry["size"])]),dtype="int8")
+            begin,end = max(lo,first_byte[ii]),min(hi,first_byte[ii+1])
+            out[begin-lo:end-lo] = chunk[begin-first_byte[ii]:end-first_byte[ii]]
+        chunks = range(np.searchsorted(first_byte,lo,side="right")-1,np.searchsorted(first_byte,hi,side="left"))
+        if self._pool is not None and len(chunks) > 1:
+            self._pool.map(fill,chunks)
+        else:
+            for ii in chunks:
+                fill(ii)
+        return out.reshape(-1,bytes_per_sample)
+
+
 class DadaFileStream(object):
-    def __init__(self, files):
-        self._files = sorted(files)
-        self._read_header()
-
-    def _read_header(self):
-        self._header = {}
-        with open(self._files[0],"r") as f:
-            header = f.read(HEADER_SIZE)
-        header = header.splitlines()
-        for line in header:
-            try:
-                key = line.split()[0]
-                if key in HEADER_PARSER.keys():
-                    self._header[key] = HEADER_PARSER[key](line.split()[1])
-            except:
-                pass
+    """
+    The files of one observation read as a single stream of samples.
+
+    The sample layout comes from the header of the first file. A header
+    and the number of samples in each file can be given, e.g. from a
+    DadaCatalog, to avoid touching the files until data are read; files
+    must then already be in order. Compressed files are decompressed on
+    nthreads threads (default one per CPU) as their samples are read, from
+    a pool shared with the other streams, see decompress_pool.
+
+    At most max_maps files are kept mapped, besides those of the current
+    read, and files wholly before the latest read are unmapped, so
+    observations of any number of files can be streamed. Data already
+    returned stay valid as they hold on to their own map.
+    """
+    def __init__(self, files, header=None, nsamps=None, nthreads=None, max_maps=MAX_OPEN_MAPS):
+        if nsamps is None:
+            files = sorted(files)
+        self._files = list(files)
+        self._header = read_header(self._files[0]) if header is None else header
+        self.layout = DadaLayout(self._header)
+        if nsamps is None:
+            nsamps = [self.layout.file_nsamps(fname) for fname in self._files]
+        self._nsamps = np.asarray(nsamps,dtype="int64")
+        self._first_sample = np.concatenate(([0],np.cumsum(self._nsamps)))
+        self._maps = OrderedDict()
+        self._max_maps = max_maps
+        self._maps_lock = threading.Lock()
+        self._nthreads = multiprocessing.cpu_count() if nthreads is None else nthreads
+
+    def __getstate__(self):
+        # Memory maps and locks are recreated on demand rather than pickled
+        state = self.__dict__.copy()
+        state["_maps"] = OrderedDict()
+        state["_maps_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._maps_lock = threading.Lock()
+
+    @property
+    def nsamps(self):
+        return int(self._first_sample[-1])
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def start_sample(self):
+        """
+        The index of the first sample counted from UTC_START.
+        """
+        return self._header.get("OBS_OFFSET",0) // self.layout.bytes_per_sample
+
+    def _map(self, idx):
+        # Called with the maps lock held
+        if idx in self._maps:
+            self._maps[idx] = self._maps.pop(idx)
+        elif self.layout.compression is not None:
+            pool = decompress_pool(self._nthreads) if self._nthreads > 1 else None
+            self._maps[idx] = CompressedDadaMap(self._files[idx],self.layout,pool)
+        else:
+            nsamps = int(self._nsamps[idx])
+            bytes_per_sample = self.layout.bytes_per_sample
+            data = np.memmap(self._files[idx],dtype="int8",mode="r",
+                offset=self.layout.header_size,shape=(nsamps*bytes_per_sample,))
+            self._maps[idx] = data.reshape(nsamps,bytes_per_sample)
+        return self._maps[idx]
+
+    def _evict(self, first, last):
+        """
+        Unmap the files before first and the least recently used files
+        beyond max_maps, keeping those from first to last.
+        """
+        for idx in [idx for idx in self._maps if idx < first]:
+            del self._maps[idx]
+        for idx in list(self._maps):
+            if len(self._maps) <= self._max_maps:
+                break
+            if idx > last:
+                del self._maps[idx]
+
+    def iter_blocks(self, nsamps, overlap=0, start=0, count=None, raw=False,
+            partial=True, prefetch_blocks=True):
+        """
+        Yield consecutive blocks of nsamps samples across the observation.
+
+        Neighbouring blocks share overlap samples, e.g. for FFT windows. The
+        last block may be shorter unless partial is False. Blocks are complex64
+        (nsamps, nchan, npol) or, with raw, (nsamps, nchan, npol, ndim) in the
+        layout dtype. Each block is only valid until the next one is
+        requested; the next block is read on a background thread while the
+        current one is processed.
+        """
+        if overlap >= nsamps:
+            raise ValueError("Overlap must be smaller than the block size")
+        end = self.nsamps if count is None else start + count
+        step = nsamps - overlap
+        ranges = []
+        block_start = start
+        while block_start < end:
+            block_count = min(nsamps,end-block_start)
+            if block_count < nsamps and not partial:
+                break
+            ranges.append((block_start,block_count))
+            if block_start + nsamps >= end:
+                break
+            block_start += step
+        layout = self.layout
+        if raw:
+            shape,dtype = (nsamps,)+layout.shape,layout.dtype
+            def fill(block,buf):
+                return self.extract(*block).raw(buf[:block[1]])
+        else:
+            shape,dtype = (nsamps,layout.nchan,layout.npol),"complex64"
+            def fill(block,buf):
+                return self.extract(*block).to_complex(buf[:block[1]])
+        nbuffers = 2 if prefetch_blocks else 1
+        buffers = [np.empty(shape,dtype=dtype) for _ in range(nbuffers)]
+        if prefetch_blocks:
+            for block in prefetch(ranges,fill,buffers):
+                yield block
+        else:
+            for block in ranges:
+                yield fill(block,buffers[0])
 
     def extract(self, start, count):
-        nsamps_per_file = self._header["FILE_SIZE"]/self._header["NCHAN"]/self._header["NDIM"]/self._header["NPOL"]
-        start_file = start/nsamps_per_file
-        print "Start file:",self._files[start_file]
-        start_offset = start - (start_file * nsamps_per_file)
-        print "Start file offset:", start_offset
-        n = [min(nsamps_per_file-start_offset,count)]
-        all_data = []
-        while sum(n) < count:
-            n.append(min(nsamps_per_file,count-sum(n)))
-        print "Read sizes:",n
-        first = True
-        for fname,nsamps in zip(self._files[start_file:start_file+len(n)],n):
-            print "Reading {} samples from {}".format(nsamps,fname)
-            with open(fname,"r") as f:
-                if first:
-                    f.seek(HEADER_SIZE + start_offset*1024)
-                    first = False
-                else:
-                    f.seek(HEADER_SIZE)
-                data = np.fromfile(f,count=nsamps*1024,dtype='byte')
-            print "Read {} bytes".format(data.size)
-            data = np.copy(data.astype("float32").view("complex64"))
-            all_data.append(data)
-        data = np.hstack(all_data)
-        return data.reshape(data.size/512,256,2)
+        """
+        Return a lazy DadaSegment of count samples from sample start.
+        """
+        if start < 0 or count < 0 or start + count > self.nsamps:
+            raise ValueError("Samples {} to {} are outside the stream of {} samples".format(
+                start,start+count,self.nsamps))
+        parts = []
+        idx = first = np.searchsorted(self._first_sample,start,side="right") - 1
+        with self._maps_lock:
+            while count > 0:
+                offset = start - self._first_sample[idx]
+                nsamps = min(self._nsamps[idx]-offset,count)
+                if nsamps > 0:
+                    parts.append(self._map(idx)[offset:offset+nsamps])
+                    start += nsamps
+                    count -= nsamps
+                idx += 1
+            self._evict(first,idx-1)
+        return DadaSegment(parts,self.layout)
+
+    def close(self):
+        with self._maps_lock:
+            self._maps = OrderedDict()
 
 
+def _set_text(record, field, value):
+    """
+    Store a string in a catalog record, which numpy would silently truncate.
+    """
+    size = CATALOG_DTYPE[field].itemsize
+    if len(value) > size:
+        raise ValueError("{} of {} bytes does not fit the {} byte catalog field: {!r}".format(
+            field,len(value),size,value[:64]))
+    record[field] = value
+
+
+class DadaCatalog(object):
+    """
+    Persistent index of the DADA files in a directory.
+
+    The parsed header, size and sample count of every file are kept in a
+    CATALOG_DTYPE array saved as CATALOG_FILENAME in the directory. On
+    opening, files are only re-read if their size or mtime has changed, so
+    streams of thousands of files are built without touching their headers.
+    """
+    def __init__(self, directory, rescan=False):
+        self.directory = directory
+        self._fname = os.path.join(directory,CATALOG_FILENAME)
+        cached = {}
+        if not rescan and os.path.isfile(self._fname):
+            try:
+                cached = dict((record["fname"],record) for record in np.load(self._fname))
+            except (IOError,ValueError):
+                print "Ignoring unreadable catalog:",self._fname
+        names = sorted(name for name in os.listdir(directory) if name.endswith(DADA_SUFFIX))
+        records = np.empty(len(names),dtype=CATALOG_DTYPE)
+        changed = len(names) != len(cached)
+        for ii,name in enumerate(names):
+            stat = os.stat(os.path.join(directory,name))
+            record = cached.get(name)
+            if record is None or record["mtime"] != stat.st_mtime or record["size"] != stat.st_size:
+                record = self._scan(name,stat)
+                changed = True
+            records[ii] = record
+        self.records = records
+        if changed:
+            self._save()
+
+    def _scan(self, name, stat):
+        with open(os.path.join(self.directory,name),"r") as f:
+            text = f.read(HEADER_SIZE).split("\0",1)[0]
+        header = parse_header(text)
+        record = np.zeros(1,dtype=CATALOG_DTYPE)[0]
+        _set_text(record,"fname",name)
+        record["mtime"] = stat.st_mtime
+        record["size"] = stat.st_size
+        # Only the parsed key/value pairs, without comments, are kept
+        _set_text(record,"header","\n".join(" ".join(line.split()[:2]) for line in text.splitlines()
+            if line.split() and line.split()[0] in HEADER_PARSER))
+        try:
+            layout = DadaLayout(header)
+        except ValueError:
+            record["nsamps"] = 0
+        else:
+            record["nsamps"] = layout.file_nsamps(os.path.join(self.directory,name),stat.st_size)
+        return record
+
+    def _save(self):
+        tmp = self._fname + ".tmp"
+        try:
+            with open(tmp,"wb") as f:
+                np.save(f,self.records)
+            os.rename(tmp,self._fname)
+        except (IOError,OSError) as error:
+            print "Could not save catalog {}: {}".format(self._fname,error)
+
+    def stems(self):
+        """
+        Return the file stems in the catalog, e.g. obs_00_01024.
+        """
+        return sorted(set(name.rsplit("_",1)[0] for name in self.records["fname"]))
+
+    def select(self, filestem):
+        """
+        Return the records of the files whose names start with filestem.
+        """
+        return self.records[np.char.startswith(self.records["fname"],filestem)]
+
+    def stream(self, filestem):
+        records = self.select(filestem)
+        if not records.size:
+            raise ValueError("No files in {} match {}".format(self.directory,filestem))
+        files = [os.path.join(self.directory,name) for name in records["fname"]]
+        return DadaFileStream(files,parse_header(records["header"][0]),records["nsamps"])
+
+
+def open_streams(filestems, rescan=False):
+    """
+    Open a DadaFileStream for each file stem, cataloguing each directory once.
+    """
+    catalogs = {}
+    streams = []
+    for filestem in filestems:
+        directory,stem = os.path.split(filestem)
+        directory = directory or "."
+        if directory not in catalogs:
+            catalogs[directory] = DadaCatalog(directory,rescan)
+        streams.append(catalogs[directory].stream(stem))
+    return streams
+
 def find_all(filestem):
-    return sorted(glob.glob(filestem+"*"))
\ No newline at end of file
+    return sorted(glob.glob(filestem+"*"))
+
+
+class AlignedDadaReader(object):
+    """
+    Reads time-aligned blocks from the streams of many antennas.
+
+    Each stream's first sample is placed in time from its UTC_START and
+    OBS_OFFSET, and reads cover only the span common to all streams. Blocks
+    are read in parallel threads straight into one (ant, time, chan, pol)
+    array.
+    """
+    def __init__(self, streams, nthreads=None):
+        self._streams = streams
+        self.layout = streams[0].layout
+        for stream in streams[1:]:
+            if (stream.layout.shape,stream.layout.nbit) != (self.layout.shape,self.layout.nbit):
+                raise ValueError("All streams must have the same sample layout")
+        reference = min(stream.header["UTC_START"] for stream in streams)
+        starts = []
+        for stream in streams:
+            seconds = (stream.header["UTC_START"] - reference).total_seconds()
+            starts.append(stream.start_sample + int(round(seconds * 1e6 / stream.header["TSAMP"])))
+        common_start = max(starts)
+        common_end = min(start + stream.nsamps for start,stream in zip(starts,streams))
+        self.start_sample = common_start
+        self.offsets = [common_start - start for start in starts]
+        self.nsamps = max(common_end - common_start,0)
+        self._nthreads = len(streams) if nthreads is None else nthreads
+        self._pool = None
+
+    @classmethod
+    def from_filestems(cls, filestems, nthreads=None):
+        return cls(open_streams(filestems),nthreads)
+
+    @property
+    def nant(self):
+        return len(self._streams)
+
+    @property
+    def streams(self):
+        return self._streams
+
+    def _shape(self, nsamps, raw):
+        if raw:
+            return (self.nant,nsamps)+self.layout.shape,self.layout.dtype
+        return (self.nant,nsamps,self.layout.nchan,self.layout.npol),np.dtype("complex64")
+
+    def read(self, start, count, out=None, raw=False):
+        """
+        Read count aligned samples from every antenna, starting at sample
+        start of the common span.
+
+        Returns complex64 (ant, time, chan, pol) or, with raw, (ant, time,
+        chan, pol, ndim) in the layout dtype, written into out if given.
+        """
+        if start < 0 or count < 0 or start + count > self.nsamps:
+            raise ValueError("Samples {} to {} are outside the common span of {} samples".format(
+                start,start+count,self.nsamps))
+        if out is None:
+            shape,dtype = self._shape(count,raw)
+            out = np.empty(shape,dtype=dtype)
+        def fill(ant):
+            segment = self._streams[ant].extract(start+self.offsets[ant],count)
+            if raw:
+                segment.raw(out[ant])
+            else:
+                segment.to_complex(out[ant])
+        if self._pool is None:
+            self._pool = ThreadPool(self._nthreads)
+        self._pool.map(fill,range(self.nant))
+        return out
+
+    def iter_blocks(self, nsamps, start=0, count=None, raw=False, partial=True):
+        """
+        Yield aligned blocks of nsamps samples, reading the next block in
+        the background while the current one is processed.
+        """
+        end = self.nsamps if count is None else start + count
+        ranges = [(block_start,min(nsamps,end-block_start)) for block_start in range(start,end,nsamps)]
+        if ranges and not partial and ranges[-1][1] < nsamps:
+            ranges = ranges[:-1]
+        shape,dtype = self._shape(nsamps,raw)
+        buffers = [np.empty(shape,dtype=dtype) for _ in range(2)]
+        def fill(block,buf):
+            return self.read(block[0],block[1],buf[:,:block[1]] if block[1] == nsamps else None,raw)
+        return prefetch(ranges,fill,buffers)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class FXCorrelator(object):
+    """
+    FX correlator for the streams of several antennas in one subband.
+
+    Each dump integrates nint spectra. The data are read in blocks of about
+    read_size samples (whole FFTs, never crossing a dump), optionally
+    upchannelised with an nfft point FFT, and cross-multiplied for all
+    baselines and polarisations with one batched matrix product per
+    channel, accumulating into the current dump. Dumps have shape
+    (nchan*nfft, nant, npol, nant, npol) with V[i,p,j,q] = sum(X[i,p] *
+    conj(X[j,q])). Only the coarse channels in chan_range are read.
+    """
+    def __init__(self, streams, nfft=1, nint=1024, offsets=None, read_size=READ_SIZE):
+        self._streams = streams
+        self._nfft = nfft
+        self._nint = nint
+        self._offsets = [0]*len(streams) if offsets is None else offsets
+        self.read_size = max(read_size // nfft,1) * nfft
+
+    @property
+    def dump_size(self):
+        return self._nfft * self._nint
+
+    def ndumps(self, start=0, count=None):
+        nsamps = min(stream.nsamps - offset - start
+            for stream,offset in zip(self._streams,self._offsets))
+        if count is not None:
+            nsamps = min(nsamps,count)
+        return max(nsamps,0) // self.dump_size
+
+    def _channelise(self, data):
+        # (nant, nsamps, nchan, npol) -> (nchan*nfft, nant*npol, nspectra)
+        nant,nsamps,nchan,npol = data.shape
+        if self._nfft > 1:
+            data = data.reshape(nant,nsamps/self._nfft,self._nfft,nchan,npol)
+            data = np.fft.fftshift(np.fft.fft(data,axis=2),axes=2)
+            data = data.transpose(0,1,3,2,4).reshape(nant,nsamps/self._nfft,nchan*self._nfft,npol)
+        return data.transpose(2,0,3,1).reshape(data.shape[2],nant*npol,data.shape[1])
+
+    def dumps(self, start=0, count=None, chan_range=None):
+        """
+        Yield the dumps of count samples from sample start of every stream,
+        restricted to the coarse channels in chan_range.
+
+        Each dump is only valid until the next one is requested; the next
+        block is read in the background while the current one is correlated.
+        """
+        layout = self._streams[0].layout
+        if layout.ndim != 2:
+            raise ValueError("Correlation needs complex (NDIM 2) data")
+        chan_range = (0,layout.nchan) if chan_range is None else chan_range
+        nchan = chan_range[1] - chan_range[0]
+        npol = layout.npol
+        nant = len(self._streams)
+        ranges = []
+        for dump in range(self.ndumps(start,count)):
+            dump_start = start + dump * self.dump_size
+            for block_start in range(dump_start,dump_start+self.dump_size,self.read_size):
+                ranges.append((block_start,min(self.read_size,dump_start+self.dump_size-block_start)))
+        def fill(block,buf):
+            data = buf[:,:block[1]]
+            for ant,(stream,offset) in enumerate(zip(self._streams,self._offsets)):
+                dest = data[ant].view("float32").reshape(block[1],nchan,npol,2)
+                stream.extract(block[0]+offset,block[1]).raw(dest,chan_range)
+            return data
+        buffers = [np.empty((nant,self.read_size,nchan,npol),dtype="complex64") for _ in range(2)]
+        vis = np.zeros((nchan*self._nfft,nant*npol,nant*npol),dtype="complex64")
+        products = np.empty_like(vis)
+        nsamps = 0
+        for data in prefetch(ranges,fill,buffers):
+            spectra = self._channelise(data)
+            np.matmul(spectra,spectra.conj().transpose(0,2,1),out=products)
+            vis += products
+            nsamps += data.shape[1]
+            if nsamps == self.dump_size:
+                yield vis.reshape(nchan*self._nfft,nant,npol,nant,npol)
+                vis[:] = 0
+                nsamps = 0
+
+    def correlate(self, start=0, count=None, chan_range=None, out=None):
+        """
+        Correlate count samples from sample start of every stream into out,
+        e.g. a memory-mapped file, of shape (ndumps, nchan*nfft, nant, npol,
+        nant, npol). Allocated if not given, which for long spans of many
+        antennas is better avoided by consuming dumps() directly.
+        """
+        for dump,vis in enumerate(self.dumps(start,count,chan_range)):
+            if out is None:
+                out = np.empty((self.ndumps(start,count),)+vis.shape,dtype=vis.dtype)
+            out[dump] = vis
+        return out
+
+    def parallel_hands(self, start=0, count=None, chan_range=None):
+        """
+        Return the antenna pairs and the sum of the parallel hands of their
+        visibilities as (nbaselines, ndumps, nchan*nfft).
+        """
+        ant1,ant2 = np.triu_indices(len(self._streams),1)
+        chan_start,chan_end = (0,self._streams[0].layout.nchan) if chan_range is None else chan_range
+        products = np.empty((ant1.size,self.ndumps(start,count),(chan_end-chan_start)*self._nfft),
+            dtype="complex64")
+        for dump,vis in enumerate(self.dumps(start,count,chan_range)):
+            # Indexing leaves the baselines last: (nchan, nbaselines)
+            products[:,dump] = (vis[:,ant1,0,ant2,0] + vis[:,ant1,1,ant2,1]).T
+        return ant1,ant2,products
+
+    def dump_seconds(self):
+        return self._streams[0].header["TSAMP"] * 1e-6 * self.dump_size
+
+    def channel_bandwidth(self):
+        header = self._streams[0].header
+        return header["BW"] * 1e6 / header["NCHAN"] / self._nfft
+
+
+def _channel_blocks(streams, nblocks):
+    edges = np.linspace(0,streams[0].layout.nchan,nblocks+1).astype("int")
+    return [(lo,hi) for lo,hi in zip(edges[:-1],edges[1:]) if hi > lo]
+
+def _map_channel_blocks(func, tasks, nprocs):
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        return pool.map(func,tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _correlate_channels(args):
+    streams,chan_range,start,count,fname,kwargs = args
+    correlator = FXCorrelator(streams,**kwargs)
+    vis = np.lib.format.open_memmap(fname,mode="r+")
+    nfft = correlator._nfft
+    correlator.correlate(start,count,chan_range,vis[:,chan_range[0]*nfft:chan_range[1]*nfft])
+    vis.flush()
+
+def correlate_parallel(streams, nprocs, fname, start=0, count=None, nchan_blocks=None, **kwargs):
+    """
+    Correlate a set of antenna streams into the .npy file fname, spreading
+    blocks of coarse channels over a pool of nprocs processes. Each process
+    reads only its own channels and writes its dumps straight into the
+    file, which is returned memory-mapped.
+    """
+    correlator = FXCorrelator(streams,**kwargs)
+    nfft = correlator._nfft
+    nant,npol = len(streams),streams[0].layout.npol
+    shape = (correlator.ndumps(start,count),streams[0].layout.nchan*nfft,nant,npol,nant,npol)
+    # Create the file for the workers to fill
+    vis = np.lib.format.open_memmap(fname,mode="w+",dtype="complex64",shape=shape)
+    del vis
+    tasks = [(streams,chans,start,count,fname,kwargs)
+        for chans in _channel_blocks(streams,nprocs if nchan_blocks is None else nchan_blocks)]
+    _map_channel_blocks(_correlate_channels,tasks,nprocs)
+    return np.lib.format.open_memmap(fname,mode="r")
+
+def _parallel_hands_channels(args):
+    streams,chan_range,start,count,kwargs = args
+    return FXCorrelator(streams,**kwargs).parallel_hands(start,count,chan_range)[2]
+
+def parallel_hands_parallel(streams, nprocs, start=0, count=None, nchan_blocks=None, **kwargs):
+    """
+    FXCorrelator.parallel_hands for blocks of coarse channels spread over a
+    pool of nprocs processes, each reading only its own channels.
+    """
+    tasks = [(streams,chans,start,count,kwargs)
+        for chans in _channel_blocks(streams,nprocs if nchan_blocks is None else nchan_blocks)]
+    ant1,ant2 = np.triu_indices(len(streams),1)
+    return ant1,ant2,np.concatenate(_map_channel_blocks(_parallel_hands_channels,tasks,nprocs),axis=2)
+
+def baseline_products(vis):
+    """
+    Return the antenna pairs and their visibilities as (nbaselines, ndumps, nchan, npol, npol).
+    """
+    ant1,ant2 = np.triu_indices(vis.shape[2],1)
+    return ant1,ant2,vis[:,:,ant1,:,ant2,:]
+
+def fringe_search(ant1, ant2, products, dump_seconds, channel_bandwidth, pad=4):
+    """
+    Find the delay and fringe rate of every baseline.
+
+    products has shape (nbaselines, ndumps, nchan). Each baseline is searched
+    with a zero-padded 2D FFT over time and frequency; the SNR is the height
+    of the peak above the mean of the delay/rate plane in units of its
+    standard deviation.
+    """
+    nbl,ndumps,nchan = products.shape
+    shape = (ndumps*pad,nchan*pad)
+    plane = np.abs(np.fft.fftshift(np.fft.fft2(products,s=shape,axes=(1,2)),axes=(1,2)))
+    plane = plane.reshape(nbl,-1)
+    peak = plane.argmax(axis=1)
+    rates = np.fft.fftshift(np.fft.fftfreq(shape[0],dump_seconds))
+    delays = np.fft.fftshift(np.fft.fftfreq(shape[1],channel_bandwidth))
+    fringes = np.empty(nbl,dtype=FRINGE_DTYPE)
+    fringes["ant1"] = ant1
+    fringes["ant2"] = ant2
+    fringes["rate"] = rates[peak // shape[1]]
+    fringes["delay"] = delays[peak % shape[1]]
+    fringes["snr"] = (plane.max(axis=1) - plane.mean(axis=1)) / plane.std(axis=1)
+    return fringes
+
+def find_fringes(streams, nprocs=1, start=0, count=None, nfft=1, nint=1024, pad=4):
+    """
+    Correlate a set of antenna streams over their common time span and
+    search the parallel hands of every baseline for fringes.
+    """
+    aligned = AlignedDadaReader(streams)
+    if count is None:
+        count = aligned.nsamps - start
+    correlator = FXCorrelator(streams,nfft,nint,aligned.offsets)
+    if nprocs > 1:
+        ant1,ant2,products = parallel_hands_parallel(streams,nprocs,start,count,
+            nfft=nfft,nint=nint,offsets=aligned.offsets)
+    else:
+        ant1,ant2,products = correlator.parallel_hands(start,count)
+    return fringe_search(ant1,ant2,products,correlator.dump_seconds(),
+        correlator.channel_bandwidth(),pad)
+
+def make_parser():
+    usage = "usage: {prog} [options] filestem [filestem ...]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('filestems', type=str, nargs='+',
+        help='The DADA file stem of each antenna, e.g. obs_00_01024')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-j','--nprocs', dest='nprocs', type=int,
+        default=1, help='The number of processes to spread channel blocks over (default is 1).')
+    optional.add_argument('-s','--start', dest='start', type=int,
+        default=0, help='The first sample to correlate (default is 0).')
+    optional.add_argument('-n','--count', dest='count', type=int,
+        default=None, help='The number of samples to correlate. Default is all of them.')
+    optional.add_argument('--nfft', dest='nfft', type=int,
+        default=1, help='The FFT length used to upchannelise each coarse channel (default is 1).')
+    optional.add_argument('--nint', dest='nint', type=int,
+        default=1024, help='The number of spectra in each integration (default is 1024).')
+    optional.add_argument('--pad', dest='pad', type=int,
+        default=4, help='The zero-padding factor of the delay/rate search (default is 4).')
+    optional.add_argument('--rescan', dest='rescan', action='store_true',
+        help='Rebuild the DADA file catalog of each directory.')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    streams = open_streams(opts.filestems,opts.rescan)
+    fringes = find_fringes(streams,opts.nprocs,opts.start,opts.count,opts.nfft,opts.nint,opts.pad)
+    print "{:>5} {:>5} {:>14} {:>14} {:>10}".format("ant1","ant2","delay (s)","rate (Hz)","snr")
+    for fringe in fringes:
+        print "{:>5} {:>5} {:>14.6e} {:>14.6e} {:>10.2f}".format(*fringe)
@@ -0,0 +1,129 @@
+import sys
+import threading
+import time
+import tornado
+from argparse import ArgumentParser
+from tornado.ioloop import IOLoop
+from katcp import DeviceServer, Sensor
+from katcp.kattypes import request, return_reply, Float
+
+ADC_SAMPLE_RATE = 1712e6
+SYNC_STATES = ("unsynchronised", "synchronising", "synchronised")
+
+# Threads running the ioloops made by start_mock_fleet
+_fleet_threads = {}
+
+class MockPacketiser(DeviceServer):
+    """
+    Stand-in for the KATCP interface of a packetiser.
+
+    Answers ?rxs-packetizer-40g-get-zero-time with the zero time as an
+    inform and ?synchronise by moving the zero time to the requested unix
+    time, rounded to a whole ADC sample, once that time is reached. The
+    zero time and sync state are also served as sensors. Every request
+    takes delay seconds, to stand in for the network and device.
+    """
+    VERSION_INFO = ("mock-packetiser", 0, 1)
+    BUILD_INFO = ("mock-packetiser", 0, 1, "")
+
+    def __init__(self, host, port, zero_time=None, delay=0.0):
+        self._zero_time = time.time() if zero_time is None else zero_time
+        self._delay = delay
+        super(MockPacketiser, self).__init__(host, port)
+
+    def setup_sensors(self):
+        self._zero_time_sensor = Sensor.float("rxs.packetizer.40g.zero-time",
+            "Unix time of the first ADC sample", "s", default=self._zero_time,
+            initial_status=Sensor.NOMINAL)
+        self._sync_state_sensor = Sensor.discrete("rxs.packetizer.40g.sync-state",
+            "Synchronisation state of the packetiser", "", SYNC_STATES,
+            default="synchronised", initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._zero_time_sensor)
+        self.add_sensor(self._sync_state_sensor)
+
+    def set_zero_time(self, zero_time):
+        self._zero_time = zero_time
+        self._zero_time_sensor.set_value(zero_time)
+        self._sync_state_sensor.set_value("synchronised")
+
+    @tornado.gen.coroutine
+    def _respond_later(self):
+        if self._delay:
+            yield tornado.gen.sleep(self._delay)
+
+    @tornado.gen.coroutine
+    def request_rxs_packetizer_40g_get_zero_time(self, req, msg):
+        """Inform the zero time of the packetiser as a unix time."""
+        yield self._respond_later()
+        req.inform(repr(self._zero_time))
+        raise tornado.gen.Return(req.make_reply("ok"))
+
+    @request(Float())
+    @return_reply()
+    @tornado.gen.coroutine
+    def request_synchronise(self, req, unix_time):
+        """Set the zero time of the packetiser to a unix time."""
+        yield self._respond_later()
+        zero_time = round(unix_time * ADC_SAMPLE_RATE) / ADC_SAMPLE_RATE
+        self._sync_state_sensor.set_value("synchronising")
+        self.ioloop.call_later(max(0.0, zero_time - time.time()), self.set_zero_time, zero_time)
+        raise tornado.gen.Return(("ok",))
+
+
+def start_mock_fleet(n, host="127.0.0.1", base_port=0, ioloop=None, **kwargs):
+    """
+    Start n mock packetisers sharing one ioloop, by default run on a daemon
+    thread of its own, and return them with their (host, port) addresses. A
+    given ioloop must be started by the caller.
+    """
+    if ioloop is None:
+        ioloop = IOLoop(make_current=False)
+        thread = threading.Thread(target=ioloop.start, name="mock-packetisers")
+        thread.daemon = True
+        thread.start()
+        _fleet_threads[ioloop] = thread
+    servers = []
+    for ii in range(n):
+        server = MockPacketiser(host, base_port + ii if base_port else 0, **kwargs)
+        server.set_ioloop(ioloop)
+        server.start()
+        servers.append(server)
+    return servers, [server.bind_address for server in servers]
+
+def stop_mock_fleet(servers, timeout=5.0):
+    """
+    Stop mock packetisers started by start_mock_fleet, and their ioloop.
+    """
+    for server in servers:
+        server.stop(timeout)
+    if servers:
+        ioloop = servers[0].ioloop
+        thread = _fleet_threads.pop(ioloop, None)
+        if thread is not None:
+            ioloop.add_callback(ioloop.stop)
+            thread.join(timeout)
+
+def make_parser():
+    usage = "usage: {prog} [options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-n','--nservers', dest='nservers', type=int,
+        default=1, help='The number of mock packetisers to run (default is 1).')
+    optional.add_argument('--host', dest='host', type=str,
+        default="127.0.0.1", help='The address to listen on (default is 127.0.0.1).')
+    optional.add_argument('-p','--port', dest='port', type=int,
+        default=7147, help='The port of the first packetiser; the rest follow on (default is 7147).')
+    optional.add_argument('-d','--delay', dest='delay', type=float,
+        default=0.0, help='Seconds each request takes to answer (default is 0).')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    ioloop = IOLoop.current()
+    servers, addresses = start_mock_fleet(opts.nservers, opts.host, opts.port, ioloop, delay=opts.delay)
+    for host, port in addresses:
+        print "Mock packetiser listening on {}:{}".format(host, port)
+    try:
+        ioloop.start()
+    except KeyboardInterrupt:
+        stop_mock_fleet(servers)
@@ -1,39 +1,177 @@
 import tornado
+import sys
+import threading
 import time
+import Queue
+from datetime import timedelta
 from tornado.ioloop import IOLoop
-from katcp import resource_client
+from tornado.locks import Condition
+from katcp import resource_client, Sensor
+from katcp.resource import escape_name
+
+ZERO_TIME_SENSOR = "rxs.packetizer.40g.zero-time"
+SYNC_STATE_SENSOR = "rxs.packetizer.40g.sync-state"
+# Readings with these statuses carry no usable value
+INVALID_STATUSES = (Sensor.UNKNOWN, Sensor.INACTIVE, Sensor.UNREACHABLE)
+# Used to wait for a new zero time on packetisers without the sensor
+POLL_INTERVAL = 0.5
+
+class PacketiserError(Exception):
+    pass
 
 class Packetiser(object):
-    def __init__(self, addr, port):
+    """
+    KATCP control of one packetiser.
+
+    The zero time and sync state sensors are sampled on events, so
+    zero_time and sync_state hold the latest readings. Unless an ioloop is
+    given the packetiser runs its own on a daemon thread, so events are
+    applied as they arrive and the blocking methods read the cache without
+    a request. With a given ioloop the readings are only updated while
+    that loop runs, so get_sync_epoch() asks the packetiser instead.
+    """
+    def __init__(self, addr, port, ioloop=None, zero_time_sensor=ZERO_TIME_SENSOR,
+            sync_state_sensor=SYNC_STATE_SENSOR):
         self._client = resource_client.KATCPClientResource(dict(
             name='packetiser-client',
             address=(addr, port),
             controlled=True))
-        self._ioloop = IOLoop.current()
+        self._thread = None
+        if ioloop is None:
+            self._ioloop = IOLoop(make_current=False)
+            self._thread = threading.Thread(target=self._ioloop.start, name="packetiser-{}:{}".format(addr, port))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._ioloop = ioloop
+        self._client.set_ioloop(self._ioloop)
+        self._zero_time_sensor = zero_time_sensor
+        self._listeners = {
+            zero_time_sensor: self._on_zero_time,
+            sync_state_sensor: self._on_sync_state
+            }
+        self._epoch_changed = Condition()
+        self.zero_time = None
+        self.sync_state = None
 
-    def start(self):
+    def _on_zero_time(self, sensor, reading):
+        if reading.istatus in INVALID_STATUSES:
+            return
+        self._set_zero_time(float(reading.value))
+
+    def _on_sync_state(self, sensor, reading):
+        if reading.istatus not in INVALID_STATUSES:
+            self.sync_state = reading.value
+
+    def _set_zero_time(self, zero_time):
+        if zero_time != self.zero_time:
+            self.zero_time = zero_time
+            self._epoch_changed.notify_all()
+
+    @property
+    def has_zero_time_sensor(self):
+        return escape_name(self._zero_time_sensor) in self._client.sensor
+
+    @tornado.gen.coroutine
+    def connect(self, timeout=None):
+        # Strategies and listeners are remembered by the client and applied
+        # as the sensors appear, and again after a reconnect
+        for name, listener in self._listeners.items():
+            yield self._client.set_sampling_strategy(name, "event")
+            yield self._client.set_sensor_listener(name, listener)
+        self._client.start()
+        yield self._client.until_synced(timeout)
+        if self.zero_time is None:
+            yield self.sync_epoch()
+
+    def _run(self, func):
+        """
+        Run a coroutine function on the ioloop and wait for its result.
+        """
+        if self._thread is None:
+            return self._ioloop.run_sync(func)
+        result = Queue.Queue()
         @tornado.gen.coroutine
-        def sync():
-            yield self._client.until_synced()
-        self._ioloop.run_sync(self._client.start)
-        self._ioloop.run_sync(sync)
+        def run():
+            try:
+                value = yield func()
+                result.put((value, None))
+            except Exception:
+                result.put((None, sys.exc_info()))
+        self._ioloop.add_callback(run)
+        value, exc_info = result.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return value
+
+    def start(self):
+        self._run(self.connect)
+
+    def stop(self):
+        if self._thread is None:
+            self._client.stop()
+            return
+        self._ioloop.add_callback(self._client.stop)
+        self._ioloop.add_callback(self._ioloop.stop)
+        self._thread.join()
+        self._thread = None
+
+    @tornado.gen.coroutine
+    def sync_epoch(self):
+        """
+        Ask the packetiser for its zero time, refreshing the cached value.
+        """
+        epoch = yield self._client.req.rxs_packetizer_40g_get_zero_time()
+        if not epoch.reply.reply_ok():
+            raise PacketiserError(str(epoch.reply))
+        self._set_zero_time(float(epoch[1][0].arguments[0]))
+        raise tornado.gen.Return(self.zero_time)
 
     def get_sync_epoch(self):
-        @tornado.gen.coroutine
-        def _get_sync_epoch():
-            epoch = yield self._client.req.rxs_packetizer_40g_get_zero_time()
-            raise tornado.gen.Return(epoch[1][0].arguments[0])
-        return self._ioloop.run_sync(_get_sync_epoch)
+        if self._thread is not None and self.zero_time is not None:
+            return self.zero_time
+        return self._run(self.sync_epoch)
+
+    @tornado.gen.coroutine
+    def until_epoch(self, previous=None, timeout=None):
+        """
+        Wait for a zero time other than previous and return it.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.zero_time is None or self.zero_time == previous:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise PacketiserError("No new zero time after {} s".format(timeout))
+            if self.has_zero_time_sensor:
+                yield self._epoch_changed.wait(None if remaining is None else timedelta(seconds=remaining))
+            else:
+                yield tornado.gen.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+                yield self.sync_epoch()
+        raise tornado.gen.Return(self.zero_time)
 
-    def synchronize(self, toff=2.0):
+    @tornado.gen.coroutine
+    def synchronise_at(self, unix):
+        reply = yield self._client.req.synchronise(unix)
+        if not reply.reply.reply_ok():
+            raise PacketiserError(str(reply.reply))
+
+    def synchronize(self, toff=2.0, wait=True, timeout=None):
+        """
+        Synchronise the packetiser toff seconds from now and, unless wait is
+        False, return the new zero time once it is reported.
+        """
         unix = time.time() + toff
+        previous = self.zero_time
         @tornado.gen.coroutine
         def _synchronize():
-            yield self._client.req.synchronise(unix)
-        self._ioloop.run_sync(_synchronize)
-
-p = Packetiser('10.96.7.41', 7147)
-p.start()
-print p.get_sync_epoch()
-p.synchronize()
-print p.get_sync_epoch()
\ No newline at end of file
+            yield self.synchronise_at(unix)
+            if wait:
+                zero_time = yield self.until_epoch(previous, toff + 10.0 if timeout is None else timeout)
+                raise tornado.gen.Return(zero_time)
+        return self._run(_synchronize)
+
+if __name__ == "__main__":
+    p = Packetiser('10.96.7.41', 7147)
+    p.start()
+    print p.get_sync_epoch()
+    print p.synchronize()
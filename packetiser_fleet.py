@@ -0,0 +1,146 @@
+import sys
+import time
+import tornado
+from argparse import ArgumentParser
+from collections import OrderedDict
+from datetime import timedelta
+from tornado.ioloop import IOLoop
+from packetiser import Packetiser, PacketiserError
+
+DEFAULT_TIMEOUT = 5.0
+# Zero times agreeing to within one ADC sample are the same
+ZERO_TIME_TOLERANCE = 1 / 1712e6
+
+class PacketiserFleet(object):
+    """
+    Drives many packetisers at once from a single ioloop.
+
+    Every packetiser keeps its own connection open for the life of the
+    fleet and each operation is sent to all of them concurrently, so a
+    whole array is synchronised in one round trip rather than one per
+    device. Operations return an OrderedDict of per-device results, each a
+    dict with the value (or None), the error (or None) and the seconds the
+    device took to answer.
+    """
+    def __init__(self, addresses, timeout=DEFAULT_TIMEOUT, ioloop=None):
+        self._ioloop = IOLoop.current() if ioloop is None else ioloop
+        self.timeout = timeout
+        self.packetisers = OrderedDict(("{}:{}".format(addr, port), Packetiser(addr, port, self._ioloop))
+            for addr, port in addresses)
+
+    @tornado.gen.coroutine
+    def _call(self, name, call, timeout):
+        start = time.time()
+        result = {"value": None, "error": None}
+        try:
+            result["value"] = yield tornado.gen.with_timeout(timedelta(seconds=timeout),
+                call(self.packetisers[name]), quiet_exceptions=(PacketiserError,))
+        except tornado.gen.TimeoutError:
+            result["error"] = "timed out after {} s".format(timeout)
+        except Exception as error:
+            result["error"] = "{}: {}".format(type(error).__name__, error)
+        result["seconds"] = time.time() - start
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _gather(self, call, timeout):
+        results = yield dict((name, self._call(name, call, timeout)) for name in self.packetisers)
+        raise tornado.gen.Return(OrderedDict((name, results[name]) for name in self.packetisers))
+
+    def _run(self, call, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        return self._ioloop.run_sync(lambda: self._gather(call, timeout))
+
+    def connect(self):
+        return self._run(lambda packetiser: packetiser.connect())
+
+    def get_zero_times(self):
+        return self._run(lambda packetiser: packetiser.sync_epoch())
+
+    def synchronise(self, toff=2.0, wait=True):
+        """
+        Synchronise every packetiser to the same unix time, toff seconds
+        from now, and return that time with the results. Unless wait is
+        False each result is the new zero time reported by the packetiser.
+        """
+        unix = time.time() + toff
+        @tornado.gen.coroutine
+        def synchronise(packetiser):
+            previous = packetiser.zero_time
+            yield packetiser.synchronise_at(unix)
+            if wait:
+                zero_time = yield packetiser.until_epoch(previous)
+                raise tornado.gen.Return(zero_time)
+        return unix, self._run(synchronise, self.timeout + toff)
+
+    def verify(self, zero_times=None, tolerance=ZERO_TIME_TOLERANCE):
+        """
+        Check that every packetiser reports the same zero time.
+
+        Returns whether they agree, the zero time of the first device that
+        answered and the names of the devices that failed or disagree.
+        """
+        zero_times = self.get_zero_times() if zero_times is None else zero_times
+        values = [result["value"] for result in zero_times.values() if result["error"] is None]
+        reference = values[0] if values else None
+        bad = [name for name, result in zero_times.items() if result["error"] is not None or
+            abs(result["value"] - reference) > tolerance]
+        return not bad and reference is not None, reference, bad
+
+    def stop(self):
+        for packetiser in self.packetisers.values():
+            packetiser.stop()
+
+
+def print_results(title, results):
+    print title
+    for name, result in results.items():
+        value = result["error"] if result["error"] is not None else repr(result["value"])
+        print "  {:<22} {:8.3f} s  {}".format(name, result["seconds"], value)
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def make_parser():
+    usage = "usage: {prog} [options] [host:port ...]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    parser.add_argument('addresses', type=str, nargs='*',
+        help='The KATCP addresses of the packetisers.')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-s','--synchronise', dest='synchronise', action='store_true',
+        help='Synchronise every packetiser before checking their zero times.')
+    optional.add_argument('--toff', dest='toff', type=float,
+        default=2.0, help='Seconds in the future to synchronise to (default is 2).')
+    optional.add_argument('-t','--timeout', dest='timeout', type=float,
+        default=DEFAULT_TIMEOUT, help='Seconds to wait for each device (default is {}).'.format(DEFAULT_TIMEOUT))
+    optional.add_argument('--mock', dest='mock', type=int,
+        default=0, help='Run this many local mock packetisers and control those instead.')
+    optional.add_argument('--mock_delay', dest='mock_delay', type=float,
+        default=0.0, help='Seconds each mock packetiser takes to answer (default is 0).')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    addresses = [parse_address(address) for address in opts.addresses]
+    if opts.mock:
+        from mock_packetiser import start_mock_fleet, stop_mock_fleet
+        servers, mock_addresses = start_mock_fleet(opts.mock, delay=opts.mock_delay)
+        addresses += mock_addresses
+    fleet = PacketiserFleet(addresses, opts.timeout)
+    start = time.time()
+    print_results("connect", fleet.connect())
+    if opts.synchronise:
+        unix, results = fleet.synchronise(opts.toff)
+        print_results("synchronise to {!r}".format(unix), results)
+    zero_times = fleet.get_zero_times()
+    print_results("zero time", zero_times)
+    consistent, zero_time, bad = fleet.verify(zero_times)
+    print "{} packetisers in {:.3f} s".format(len(addresses), time.time() - start)
+    fleet.stop()
+    if opts.mock:
+        stop_mock_fleet(servers)
+    if not consistent:
+        print "Zero times disagree or could not be read: {}".format(", ".join(bad))
+        sys.exit(1)
+    print "All packetisers report zero time {!r}".format(zero_time)
@@ -1,14 +1,24 @@
 import struct
-import pcapy
 import socket
 import io
+import mmap
+import select
+import signal
+import errno
+import time
+import json
 import numpy as np
 import ctypes
 import os
 import sys
+from argparse import ArgumentParser
 import jinja2
+import multiprocessing
+import threading
+import Queue
+from multiprocessing.sharedctypes import RawArray
 from astropy.time import Time
-from collections import deque
+from dada_format import COMPRESSION_CODECS, CHUNK_INDEX_DTYPE
 
 descriptor_map = {
     1:"heap_counter",
@@ -54,6 +64,74 @@ FULL_DTYPE = [
 TICKS_PER_HEAP = 2097152
 NSAMPS_PER_PACKET = 256
 NPOL = 2
+TICKS_PER_SAMPLE = TICKS_PER_HEAP / NSAMPS_PER_PACKET
+
+#14 byte ethII header + 20 byte ipv4 header + 8 byte udp header + 8 byte spead header
+SPEAD_ITEMS_OFFSET = 50
+SPEAD_NITEMS = 11
+SPEAD_PAYLOAD_SIZE = NSAMPS_PER_PACKET * NPOL * 2
+SPEAD_PAYLOAD_OFFSET = SPEAD_ITEMS_OFFSET + SPEAD_NITEMS * 8
+SPEAD_FRAME_SIZE = SPEAD_PAYLOAD_OFFSET + SPEAD_PAYLOAD_SIZE
+
+DESCRIPTOR_ID_SHIFT = np.uint64(48)
+DESCRIPTOR_ID_MASK = np.uint64(0x7fff)
+DESCRIPTOR_VALUE_MASK = np.uint64((1<<48)-1)
+
+# In-place view of a raw F-engine frame, the items are 64-bit big endian words
+FRAME_DTYPE = np.dtype({
+    "names": ["items","data"],
+    "formats": [(">u8",SPEAD_NITEMS),("int8",(NSAMPS_PER_PACKET,NPOL,2))],
+    "offsets": [SPEAD_ITEMS_OFFSET,SPEAD_PAYLOAD_OFFSET],
+    "itemsize": SPEAD_FRAME_SIZE
+    })
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1":"<",
+    b"\xa1\xb2\xc3\xd4":">",
+    b"\x4d\x3c\xb2\xa1":"<",
+    b"\xa1\xb2\x3c\x4d":">"
+}
+PCAP_GLOBAL_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_MIN_BLOCK_SIZE = 12
+MIN_INDEX_RUN = 64
+MAX_INDEX_RUN = 65536
+NSLOTS_PER_WORKER = 4
+WORKER_POLL_INTERVAL = 1.0
+DADA_HEADER_SIZE = 4096
+UDP_PAYLOAD_OFFSET = SPEAD_ITEMS_OFFSET - 8
+LIVE_RING_BATCHES = 4
+# Gaps in a stream of up to this many heaps (about 10 s) are filled with
+# zeros. A packet further ahead, e.g. with a corrupt timestamp, is dropped.
+MAX_HEAP_GAP = 8192
+
+# Sidecar index entry for each F-engine frame in a capture
+INDEX_DTYPE = np.dtype([
+    ("offset","int64"),
+    ("timestamp","uint64"),
+    ("feng_id","uint64"),
+    ("frequency","uint64"),
+    ("heap_offset","uint32")
+    ])
+INDEX_SUFFIX = ".idx.npy"
+
+CHUNK_SIZE = 1048576
+
+PACKET_DTYPE = np.dtype([
+    ("heap_counter","uint64"),
+    ("heap_size","uint64"),
+    ("heap_offset","uint64"),
+    ("payload_size","uint64"),
+    ("timestamp","uint64"),
+    ("feng_id","uint64"),
+    ("frequency","uint64"),
+    ("feng_raw","uint64"),
+    ("data","int8",(NSAMPS_PER_PACKET,NPOL,2))
+    ])
 
 DADA_HEADER = """
 HEADER       DADA                # Distributed aquisition and data analysis
@@ -70,13 +148,13 @@ SECONDARY    unset               # secondary node host name
 FILE_NAME    unset               # full path of the data file
 
 FILE_SIZE    {{filesize}}  # requested file size
-FILE_NUMBER  0             # number of data file
+FILE_NUMBER  {{file_number}}  # number of data file
 
 # time of the rising edge of the first time sample
 UTC_START    {{utc_start}}               # yyyy-mm-dd-hh:mm:ss.fs
 MJD_START    {{mjd}}            # MJD equivalent to the start UTC
 
-OBS_OFFSET   0                   # bytes offset from the start MJD/UTC
+OBS_OFFSET   {{obs_offset}}      # bytes offset from the start MJD/UTC
 OBS_OVERLAP  0                   # bytes by which neighbouring files overlap
 
 # description of the source
@@ -99,12 +177,19 @@ NPOL         {{npol}}                   # number of polarizations observed
 NCHAN        {{nchan}}                  # number of channels here
 RESOLUTION   {{resolution}}             # a parameter that is unclear
 DSB          {{dsb}}
+{% if compression %}
+COMPRESSION  {{compression}}            # codec of the data chunks
+CHUNK_SIZE   {{chunk_size}}             # uncompressed bytes per chunk
+NCHUNKS      {{nchunks}}                # entries in the chunk index after the header
+{% endif %}
 # end of header
 """
 
 DADA_DEFAULTS = {
     "obs_id": "unset",
     "filesize": 2500000000,
+    "file_number": 0,
+    "obs_offset": 0,
     "mjd": 55555.55555,
     "source": "B1937+21",
     "ra": "00:00:00.00",
@@ -120,12 +205,26 @@ DADA_DEFAULTS = {
     "npol": 2,
     "nchan": 1,
     "resolution":1,
-    "dsb":0
+    "dsb":0,
+    "compression":None,
+    "chunk_size":0,
+    "nchunks":0
 }
 
 def dada_defaults():
     return DADA_DEFAULTS.copy()
 
+_dada_header_template = None
+
+def dada_header_template():
+    """
+    Return the compiled DADA header template, compiling it on first use.
+    """
+    global _dada_header_template
+    if _dada_header_template is None:
+        _dada_header_template = jinja2.Template(DADA_HEADER)
+    return _dada_header_template
+
 def render_dada_header(overrides):
     defaults = DADA_DEFAULTS.copy()
     defaults.update(overrides)
@@ -134,7 +233,7 @@ def render_dada_header(overrides):
     defaults.update({
         "bytes_per_second": bytes_per_second,
     })
-    return jinja2.Template(DADA_HEADER).render(**defaults)
+    return dada_header_template().render(**defaults)
 
 class Descriptor(ctypes.BigEndianStructure):
     _fields_ = [
@@ -224,46 +323,713 @@ def parse_packet_lite(data):
     stream.close()
     return header
 
+def frame_dtype(frame_size):
+    return np.dtype((np.void,frame_size))
+
+def frames_to_array(frames):
+    """
+    Pack raw frames into an array of void records, one per frame.
+
+    Frames that are not F-engine SPEAD packets (wrong length) are dropped.
+    """
+    dtype = frame_dtype(SPEAD_FRAME_SIZE)
+    if isinstance(frames, np.ndarray):
+        if frames.dtype.kind == "V":
+            return frames
+        return np.ascontiguousarray(frames,dtype="uint8").view(dtype).reshape(-1)
+    frames = [frame for frame in frames if len(frame) == SPEAD_FRAME_SIZE]
+    if not frames:
+        return np.empty(0,dtype=dtype)
+    return np.frombuffer(b"".join(frames),dtype=dtype)
+
+def decode_descriptors(raw, names):
+    """
+    Extract the named descriptor values from FRAME_DTYPE records.
+
+    Descriptors are matched by id rather than by position.
+    """
+    items = raw["items"].astype("uint64")
+    ids = (items >> DESCRIPTOR_ID_SHIFT) & DESCRIPTOR_ID_MASK
+    values = items & DESCRIPTOR_VALUE_MASK
+    descriptors = {}
+    for descriptor_id,name in descriptor_map.items():
+        if name not in names:
+            continue
+        if raw.size:
+            descriptors[name] = np.where(ids == descriptor_id, values, 0).max(axis=1)
+        else:
+            descriptors[name] = np.empty(0,dtype="uint64")
+    return descriptors
+
+def parse_packet_batch(frames):
+    """
+    Decode a batch of raw frames into a PACKET_DTYPE structured array.
+
+    This is the vectorised equivalent of calling parse_packet_lite on every
+    frame.
+    """
+    raw = frames_to_array(frames).view(FRAME_DTYPE)
+    packets = np.empty(raw.size,dtype=PACKET_DTYPE)
+    for name,values in decode_descriptors(raw,descriptor_map.values()).items():
+        packets[name] = values
+    packets["data"] = raw["data"]
+    return packets
+
+def stream_keys(raw):
+    descriptors = decode_descriptors(raw,("feng_id","frequency"))
+    return (descriptors["feng_id"] << np.uint64(32)) | descriptors["frequency"]
+
+class PcapReader(object):
+    """
+    Zero-copy reader for pcap and pcapng captures.
+
+    The capture is memory mapped and its record headers are walked once to
+    build arrays of frame offsets and lengths. Frames are then served in
+    batches of void records that view the mapping directly.
+    """
+    def __init__(self, fname, build_index=True):
+        self._file = open(fname,"rb")
+        self._mm = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        self.offsets = np.empty(0,dtype="int64")
+        self.lengths = np.empty(0,dtype="uint32")
+        magic = self._mm[:4]
+        if magic in PCAP_MAGIC:
+            if build_index:
+                self.offsets, self.lengths = self._index_pcap(PCAP_MAGIC[magic])
+        elif struct.unpack("<I",magic)[0] == PCAPNG_SECTION_HEADER:
+            if build_index:
+                self.offsets, self.lengths = self._index_pcapng()
+        else:
+            self.close()
+            raise IOError("{} is not a pcap or pcapng file".format(fname))
+
+    def __len__(self):
+        return self.offsets.size
+
+    def __getitem__(self, idx):
+        offset = self.offsets[idx]
+        return self._mm[offset:offset+self.lengths[idx]]
+
+    def _index_pcap(self, endian):
+        # Captures are mostly runs of equal length frames, so the record
+        # headers are checked a run at a time with a strided view.
+        size = len(self._mm)
+        offsets = []
+        lengths = []
+        pos = PCAP_GLOBAL_HEADER_SIZE
+        nrun = MIN_INDEX_RUN
+        while pos + PCAP_RECORD_HEADER_SIZE <= size:
+            length = struct.unpack_from(endian+"I",self._mm,pos+8)[0]
+            stride = PCAP_RECORD_HEADER_SIZE + length
+            count = min(nrun,(size-pos)/stride)
+            if count == 0:
+                break
+            incl_len = np.ndarray((count,),dtype=endian+"u4",buffer=self._mm,
+                offset=pos+8,strides=(stride,))
+            mismatch = np.flatnonzero(incl_len != length)
+            if mismatch.size:
+                count = mismatch[0]
+                nrun = MIN_INDEX_RUN
+            else:
+                nrun = min(2*nrun,MAX_INDEX_RUN)
+            offsets.append(pos + PCAP_RECORD_HEADER_SIZE + stride*np.arange(count,dtype="int64"))
+            lengths.append(np.repeat(np.uint32(length),count))
+            pos += count * stride
+        if not offsets:
+            return np.empty(0,dtype="int64"), np.empty(0,dtype="uint32")
+        return np.concatenate(offsets), np.concatenate(lengths)
+
+    def _index_pcapng(self):
+        size = len(self._mm)
+        offsets = []
+        lengths = []
+        endian = "<"
+        pos = 0
+        while pos + PCAPNG_MIN_BLOCK_SIZE <= size:
+            block_type = struct.unpack_from(endian+"I",self._mm,pos)[0]
+            if block_type == PCAPNG_SECTION_HEADER:
+                magic = struct.unpack_from("<I",self._mm,pos+8)[0]
+                endian = "<" if magic == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            block_len = struct.unpack_from(endian+"I",self._mm,pos+4)[0]
+            if block_len < PCAPNG_MIN_BLOCK_SIZE:
+                raise IOError("Corrupt pcapng block at offset {}".format(pos))
+            if pos + block_len > size:
+                break
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                offsets.append(pos+28)
+                lengths.append(struct.unpack_from(endian+"I",self._mm,pos+20)[0])
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                orig_len = struct.unpack_from(endian+"I",self._mm,pos+8)[0]
+                offsets.append(pos+12)
+                lengths.append(min(orig_len,block_len-16))
+            pos += block_len
+        return np.array(offsets,dtype="int64"), np.array(lengths,dtype="uint32")
+
+    def frames(self, offsets, frame_size):
+        """
+        Return the frames at the given offsets as an array of void records.
+
+        Equally spaced frames are returned as a view onto the mapped file,
+        otherwise each equally spaced run is copied into a new array.
+        """
+        dtype = frame_dtype(frame_size)
+        steps = np.diff(offsets)
+        bounds = np.concatenate(([0],np.flatnonzero(steps[1:] != steps[:-1])+2,[offsets.size]))
+        bounds = np.unique(np.clip(bounds,0,offsets.size))
+        runs = []
+        for start,stop in zip(bounds[:-1],bounds[1:]):
+            stride = int(steps[start]) if stop - start > 1 else frame_size
+            runs.append(np.ndarray((stop-start,),dtype=dtype,buffer=self._mm,
+                offset=int(offsets[start]),strides=(stride,)))
+        if len(runs) == 1:
+            return runs[0]
+        out = np.empty(offsets.size,dtype=dtype)
+        for start,run in zip(bounds[:-1],runs):
+            out[start:start+run.size] = run
+        return out
+
+    def batches(self, batch_size, frame_size=None, indices=None):
+        """
+        Yield batches of at most batch_size frames of length frame_size.
+
+        Frames of any other length are skipped. If indices is given only
+        those frames are considered, otherwise the whole capture is read.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        if frame_size is None and indices.size:
+            frame_size = int(self.lengths[indices[0]])
+        offsets = self.offsets[indices[self.lengths[indices] == frame_size]]
+        return self.batches_at(offsets,batch_size,frame_size)
+
+    def batches_at(self, offsets, batch_size, frame_size):
+        """
+        Yield batches of at most batch_size frames found at the given offsets.
+        """
+        for start in range(0,offsets.size,batch_size):
+            yield self.frames(offsets[start:start+batch_size],frame_size)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+def index_filename(fname):
+    return fname + INDEX_SUFFIX
+
+def build_packet_index(reader, batch_size):
+    """
+    Build an INDEX_DTYPE array describing every F-engine frame in a capture.
+    """
+    parts = []
+    for frames in reader.batches(batch_size,SPEAD_FRAME_SIZE):
+        descriptors = decode_descriptors(frames.view(FRAME_DTYPE),
+            ("timestamp","feng_id","frequency","heap_offset"))
+        part = np.empty(frames.size,dtype=INDEX_DTYPE)
+        for name,values in descriptors.items():
+            part[name] = values
+        parts.append(part)
+    index = np.concatenate(parts) if parts else np.empty(0,dtype=INDEX_DTYPE)
+    index["offset"] = reader.offsets[reader.lengths == SPEAD_FRAME_SIZE]
+    return index
+
+def load_packet_index(fname, batch_size=4096, rebuild=False):
+    """
+    Load the sidecar index of a capture, (re)building it if it is missing,
+    older than the capture, written with another INDEX_DTYPE or a rebuild
+    is requested.
+    """
+    index_fname = index_filename(fname)
+    if (not rebuild and os.path.isfile(index_fname) and
+        os.path.getmtime(index_fname) >= os.path.getmtime(fname)):
+        index = np.load(index_fname,mmap_mode="r")
+        if index.dtype == INDEX_DTYPE:
+            return index
+    print "Building packet index:",index_fname
+    reader = PcapReader(fname)
+    index = build_packet_index(reader,batch_size)
+    reader.close()
+    np.save(index_fname,index)
+    return index
+
+def select_packets(index, feng_ids=None, subbands=None, time_range=None, ticks_per_second=None):
+    """
+    Return the file offsets of the indexed frames that pass all filters.
+
+    The time range is a (start, end) pair in seconds from the first
+    packet of the capture.
+    """
+    mask = np.ones(index.size,dtype="bool")
+    if feng_ids is not None:
+        mask &= np.in1d(index["feng_id"],feng_ids)
+    if subbands is not None:
+        mask &= np.in1d(index["frequency"],subbands)
+    if time_range is not None and index.size:
+        start,end = time_range
+        elapsed = (index["timestamp"] - index["timestamp"].min()) / float(ticks_per_second)
+        mask &= (elapsed >= start) & (elapsed < end)
+    return index["offset"][mask]
+
+def is_multicast(addr):
+    return 224 <= int(addr.split(".")[0]) <= 239
+
+class MulticastReceiver(object):
+    """
+    Batched receiver for F-engine SPEAD packets on a UDP (multicast) group.
+
+    Packets are received straight into a preallocated ring of frames at the
+    offset they would have in a captured ethernet frame, so batches can be
+    decoded exactly like frames from a PcapReader. Each batch drains the
+    socket until it would block or the batch is full, in the spirit of
+    recvmmsg.
+    """
+    def __init__(self, group, port, interface="0.0.0.0", ring_size=16384, rcvbuf=None):
+        self._sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
+        self._sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        if rcvbuf is not None:
+            self._sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,rcvbuf)
+        self._sock.bind((group,port))
+        if is_multicast(group):
+            mreq = socket.inet_aton(group) + socket.inet_aton(interface)
+            self._sock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,mreq)
+        self._sock.settimeout(0.0)
+        self._ring = np.zeros((ring_size,SPEAD_FRAME_SIZE),dtype="uint8")
+        self._frames = self._ring.view(frame_dtype(SPEAD_FRAME_SIZE)).reshape(-1)
+        self._slots = [memoryview(row)[UDP_PAYLOAD_OFFSET:] for row in self._ring]
+        self.received = 0
+        self.invalid = 0
+        self._stopped = False
+
+    def _receive_batch(self, start, batch_size, timeout):
+        count = 0
+        try:
+            if not select.select([self._sock],[],[],timeout)[0]:
+                return count
+        except select.error as error:
+            # A signal, e.g. the SIGINT that stops the capture
+            if error.args[0] != errno.EINTR:
+                raise
+            return count
+        while count < batch_size:
+            try:
+                nbytes = self._sock.recv_into(self._slots[start+count])
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    break
+                raise
+            if nbytes != SPEAD_FRAME_SIZE - UDP_PAYLOAD_OFFSET:
+                self.invalid += 1
+                continue
+            count += 1
+        self.received += count
+        return count
+
+    def batches(self, batch_size, max_packets=None, duration=None, timeout=1.0):
+        """
+        Yield batches of at most batch_size frames as views onto the ring.
+
+        A batch is only valid until the ring wraps around to it again.
+        Receiving stops after max_packets packets, after duration seconds or
+        once stop() is called.
+        """
+        nbatches = self._ring.shape[0] / batch_size
+        if nbatches < 1:
+            raise ValueError("Ring of {} frames cannot hold a batch of {}".format(
+                self._ring.shape[0],batch_size))
+        deadline = None if duration is None else time.time() + duration
+        batch = 0
+        while not self._stopped and (max_packets is None or self.received < max_packets):
+            if deadline is not None and time.time() >= deadline:
+                break
+            nframes = batch_size
+            if max_packets is not None:
+                nframes = min(batch_size,max_packets-self.received)
+            start = batch * batch_size
+            count = self._receive_batch(start,nframes,timeout)
+            if count:
+                yield self._frames[start:start+count]
+                batch = (batch + 1) % nbatches
+
+    def stop(self):
+        """
+        Stop the batches after the current one. Safe to call from a signal handler.
+        """
+        self._stopped = True
+
+    def kernel_drops(self):
+        """
+        Return the number of packets the kernel dropped for this socket.
+        """
+        inode = os.fstat(self._sock.fileno()).st_ino
+        with open("/proc/net/udp") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if int(fields[9]) == inode:
+                    return int(fields[-1])
+        return 0
+
+    def report(self):
+        print "Received packets:",self.received
+        print "Invalid packets:",self.invalid
+        print "Packets dropped by the kernel:",self.kernel_drops()
+
+    def close(self):
+        self._sock.close()
+
 def read_pcap_spead_stream(fname,npackets):
-    packets = pcapy.open_offline(fname)
-    data = []
-    for _ in range(npackets):
-        packet = packets.next()
-        if packet[0] is not None:
-            data.append(parse_packet(packet[1]))
+    reader = PcapReader(fname)
+    data = [parse_packet(reader[ii]) for ii in range(min(npackets,len(reader)))]
+    reader.close()
     return data
 
-class Heap(object):
-    def __init__(self, nchans, nsamps, npol):
-        self._data = np.zeros([nchans,nsamps,npol,2],dtype="byte")
+class RateCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def add(self, count, nbytes, seconds):
+        self.count += count
+        self.nbytes += nbytes
+        self.seconds += seconds
+
+    def merge(self, other):
+        self.add(other["count"],other["bytes"],other["seconds"])
+
+    def to_dict(self):
+        seconds = max(self.seconds,1e-9)
+        return {
+            "count": self.count,
+            "bytes": self.nbytes,
+            "seconds": self.seconds,
+            "count_per_second": self.count / seconds,
+            "bytes_per_second": self.nbytes / seconds
+        }
+
+
+class StreamStats(object):
+    """
+    Loss and reordering counters for one (feng_id, subband) stream.
+
+    missing counts packets that never arrived in written heaps and the
+    completeness histogram counts written heaps by their number of packets.
+    ahead counts packets dropped for being too far beyond the stream.
+    """
+    def __init__(self):
+        self.received = 0
+        self.late = 0
+        self.ahead = 0
+        self.duplicates = 0
+        self.missing = 0
+        self.heaps = 0
+        self.completeness = None
+
+    def heaps_flushed(self, filled):
+        """
+        Count written heaps from their (nheaps, nchans) channel filled flags.
+        """
+        nheaps,nchans = filled.shape
+        nfilled = np.count_nonzero(filled,axis=1)
+        if self.completeness is None:
+            self.completeness = np.zeros(nchans+1,dtype="int64")
+        self.completeness += np.bincount(nfilled,minlength=nchans+1)
+        self.missing += nheaps * nchans - int(nfilled.sum())
+        self.heaps += nheaps
+
+    def to_dict(self):
+        return {
+            "received": self.received,
+            "late": self.late,
+            "ahead": self.ahead,
+            "duplicates": self.duplicates,
+            "missing": self.missing,
+            "heaps": self.heaps,
+            "completeness": [] if self.completeness is None else self.completeness.tolist()
+        }
+
+
+def format_stats(stats):
+    lines = ["{:>8} {:>8} {:>10} {:>8} {:>8} {:>10} {:>8} {:>8} {:>8}".format(
+        "feng_id","subband","received","late","ahead","duplicates","missing","heaps","complete")]
+    for key in sorted(stats["streams"],key=lambda key: map(int,key.split(":"))):
+        stream = stats["streams"][key]
+        complete = stream["completeness"][-1] if stream["completeness"] else 0
+        lines.append("{:>8} {:>8} {:>10} {:>8} {:>8} {:>10} {:>8} {:>8} {:>8}".format(
+            *(key.split(":") + [stream["received"],stream["late"],stream["ahead"],stream["duplicates"],
+            stream["missing"],stream["heaps"],complete])))
+    for stage,unit in (("decode","packets"),("assemble","packets"),("write","heaps")):
+        rate = stats[stage]
+        lines.append("{}: {} {unit}, {} bytes in {:.3f} s ({:.0f} {unit}/s, {:.2f} MB/s)".format(
+            stage.capitalize(),rate["count"],rate["bytes"],rate["seconds"],
+            rate["count_per_second"],rate["bytes_per_second"]/1e6,unit=unit))
+    lines.append("Elapsed: {:.3f} s".format(stats["elapsed"]))
+    return "\n".join(lines)
+
+def merge_stats(all_stats):
+    merged = {"elapsed": 0.0, "streams": {}}
+    for stage in ("decode","assemble","write"):
+        rate = RateCounter()
+        for stats in all_stats:
+            rate.merge(stats[stage])
+        merged[stage] = rate.to_dict()
+    for stats in all_stats:
+        merged["elapsed"] = max(merged["elapsed"],stats["elapsed"])
+        merged["streams"].update(stats["streams"])
+    return merged
+
+def dump_stats(stats, fname):
+    with open(fname+".tmp","w") as f:
+        json.dump(stats,f,indent=1)
+    os.rename(fname+".tmp",fname)
 
-    def add(self, packet):
-        channel_id = packet["heap_offset"] / packet["payload_size"]
-        self._data[channel_id,:,:,:] = packet['data']
 
-    def reset(self):
-        self._data[:] = 0
+class BackgroundWriter(object):
+    """
+    Runs file writes on a thread so that parsing never blocks on disk.
 
-    def to_dada_order(self):
-        return self._data.transpose(1,0,2,3)
+    Tasks run in submission order. The first error raised by a task is
+    re-raised in the submitting thread on the next submit or on stop.
+    """
+    def __init__(self, maxsize=64):
+        self._queue = Queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            func,args = task
+            if self._error is None:
+                try:
+                    func(*args)
+                except Exception as error:
+                    self._error = error
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, func, *args):
+        self._check()
+        self._queue.put((func,args))
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+
+class CompressedDadaFile(object):
+    """
+    Output file holding its data as independently compressed chunks.
+
+    Data are cut into chunks of chunk_size bytes that are each compressed
+    with codec at level. Room for an index of nchunks CHUNK_INDEX_DTYPE
+    entries is reserved straight after the header and filled in on close,
+    giving the offset, compressed size and uncompressed size of every
+    chunk, so any range of samples can be read back without decompressing
+    the rest.
+    """
+    def __init__(self, filename, header, nchunks, chunk_size, level=1, codec="zlib"):
+        self._file = open(filename,"wb")
+        self._file.write(header)
+        self._index_offset = self._file.tell()
+        self._index = np.zeros(nchunks,dtype=CHUNK_INDEX_DTYPE)
+        self._index.tofile(self._file)
+        self._chunk = np.empty(chunk_size,dtype="byte")
+        self._fill = 0
+        self._nchunks = 0
+        self._level = level
+        self._compress = COMPRESSION_CODECS[codec][0]
+
+    def _write_chunk(self, data):
+        if self._nchunks == self._index.size:
+            raise ValueError("More than {} chunks written to {}".format(self._index.size,self._file.name))
+        payload = self._compress(data,self._level)
+        self._index[self._nchunks] = (self._file.tell(),len(payload),data.size)
+        self._file.write(payload)
+        self._nchunks += 1
+
+    def write(self, data):
+        chunk_size = self._chunk.size
+        pos = 0
+        while pos < data.size:
+            if self._fill == 0 and data.size - pos >= chunk_size:
+                # Whole chunks are compressed straight from the input
+                self._write_chunk(data[pos:pos+chunk_size])
+                pos += chunk_size
+                continue
+            nbytes = min(chunk_size-self._fill,data.size-pos)
+            self._chunk[self._fill:self._fill+nbytes] = data[pos:pos+nbytes]
+            self._fill += nbytes
+            pos += nbytes
+            if self._fill == chunk_size:
+                self._write_chunk(self._chunk)
+                self._fill = 0
+
+    def close(self):
+        if self._fill:
+            self._write_chunk(self._chunk[:self._fill])
+            self._fill = 0
+        self._file.seek(self._index_offset)
+        self._index.tofile(self._file)
+        self._file.close()
+
+
+class DadaWriter(object):
+    """
+    Write-combining writer for a stream of heaps in DADA order.
+
+    Heaps are transposed into a preallocated contiguous staging block that
+    is written out in one go once full. Output rolls over to a new file
+    every FILE_SIZE bytes, each with its own FILE_NUMBER and OBS_OFFSET, in
+    the same way as dada_dbdisk, counting on from the OBS_OFFSET in the
+    header. Files are named {stem}_{obs_offset}.dada.
+
+    With a compression codec the data of each file are written as a
+    CompressedDadaFile of chunk_size byte chunks, rounded down to whole
+    samples, and the codec and chunk layout are recorded in the header.
+    """
+    def __init__(self, stem, header, nchans, block_size, background=None, rate=None,
+            compression=None, chunk_size=CHUNK_SIZE, level=1):
+        self._stem = stem
+        self._rate = rate
+        self._header = header.copy()
+        bytes_per_sample = header["nchan"] * header["npol"] * header["ndim"] * header["nbit"] / 8
+        self._filesize = int(header["filesize"] - header["filesize"] % bytes_per_sample)
+        self._header["filesize"] = self._filesize
+        self._compression = compression
+        self._level = level
+        if compression is not None:
+            if compression not in COMPRESSION_CODECS:
+                raise ValueError("Unknown compression {}".format(compression))
+            self._chunk_size = int(max(bytes_per_sample,chunk_size - chunk_size % bytes_per_sample))
+            self._header["compression"] = compression
+            self._header["chunk_size"] = self._chunk_size
+            self._header["nchunks"] = -(-self._filesize // self._chunk_size)
+        self._file = None
+        self._file_number = -1
+        self._obs_offset = int(header["obs_offset"])
+        self._remaining = 0
+        self._background = background
+        heap_shape = (NSAMPS_PER_PACKET,nchans,NPOL,2)
+        nheaps_per_block = max(1,block_size / np.prod(heap_shape))
+        self._free = Queue.Queue()
+        for _ in range(2 if background is not None else 1):
+            self._free.put(np.empty((nheaps_per_block,)+heap_shape,dtype="byte"))
+        self._staging = self._free.get()
+        self._fill = 0
+
+    def _open_next(self):
+        if self._file is not None:
+            self._file.close()
+        self._file_number += 1
+        header = self._header.copy()
+        header["file_number"] = self._file_number
+        header["obs_offset"] = self._obs_offset
+        filename = "%s_%016d.dada"%(self._stem,self._obs_offset)
+        text = render_dada_header(header).ljust(DADA_HEADER_SIZE,"\0")
+        if self._compression is not None:
+            self._file = CompressedDadaFile(filename,text,header["nchunks"],self._chunk_size,self._level,
+                self._compression)
+        else:
+            self._file = open(filename,"wb")
+            self._file.write(text)
+        self._remaining = self._filesize
+
+    def _write(self, staging, count):
+        start = time.time()
+        data = staging[:count].reshape(-1)
+        pos = 0
+        try:
+            while pos < data.size:
+                if self._remaining == 0:
+                    self._open_next()
+                nbytes = min(self._remaining,data.size-pos)
+                if self._compression is not None:
+                    self._file.write(data[pos:pos+nbytes])
+                else:
+                    data[pos:pos+nbytes].tofile(self._file)
+                pos += nbytes
+                self._remaining -= nbytes
+                self._obs_offset += nbytes
+        finally:
+            # Hand the buffer back even if the write failed, so flush never waits on it
+            self._free.put(staging)
+        if self._rate is not None:
+            self._rate.add(count,data.size,time.time()-start)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def write_heaps(self, heaps):
+        """
+        Write (nheaps, nsamps, nchans, npol, 2) heaps in DADA order.
+        """
+        pos = 0
+        while pos < heaps.shape[0]:
+            count = min(heaps.shape[0]-pos,self._staging.shape[0]-self._fill)
+            self._staging[self._fill:self._fill+count] = heaps[pos:pos+count]
+            self._fill += count
+            pos += count
+            if self._fill == self._staging.shape[0]:
+                self.flush()
+
+    def flush(self):
+        if self._fill == 0:
+            return
+        if self._background is not None:
+            self._background.submit(self._write,self._staging,self._fill)
+        else:
+            self._write(self._staging,self._fill)
+        self._staging = self._next_staging()
+        self._fill = 0
+
+    def _next_staging(self):
+        # Tasks queued behind a failed write are skipped and never return
+        # their buffer, so keep checking for the error while waiting
+        while True:
+            try:
+                return self._free.get(timeout=WORKER_POLL_INTERVAL)
+            except Queue.Empty:
+                if self._background is not None:
+                    self._background._check()
+
+    def close(self):
+        self.flush()
+        if self._background is not None:
+            self._background.submit(self._close)
+        else:
+            self._close()
 
 
 class AntennaSubbandRingBuffer(object):
-    def __init__(self, antenna_id, subband_id, opts):
+    def __init__(self, antenna_id, subband_id, opts, background=None, write_rate=None):
         print "New AntennaSubbandRingBuffer instance created"
         print "Antenna:",antenna_id
         print "Subband:",subband_id
         self._first_pass = True
-        self._nheaps = 3
+        self._nheaps = opts.nheaps
+        self._max_gap = opts.max_gap
+        self._opts = opts
+        self._background = background
+        self._write_rate = write_rate
+        self._writer = None
+        self.stats = StreamStats()
         if opts.prefix is not None:
-            filename = "%s_%02d_%05d.dada"%(opts.prefix,antenna_id,subband_id)
+            self._stem = "%s_%02d_%05d"%(opts.prefix,antenna_id,subband_id)
         else:
-            filename = "%02d_%05d.dada"%(antenna_id,subband_id)
-        self.file = open(filename,"w")
-        print "Output filename:",filename
+            self._stem = "%02d_%05d"%(antenna_id,subband_id)
+        print "Output file stem:",self._stem
 
-    def _write_header(self,packet):
+    def _make_header(self,packet):
+        opts = self._opts
         header = dada_defaults()
+        header['filesize'] = opts.filesize
         header['nchan'] = packet['heap_size'] / packet['payload_size']
         chbw = opts.bandwidth/opts.nchan
         header['bandwidth'] = header['nchan'] * chbw
@@ -275,95 +1041,416 @@ class AntennaSubbandRingBuffer(object):
         t = Time(opts.global_sync_epoch,format="unix",scale="utc",precision=9)
         header['utc_start'] = t.iso.replace(" ","-")
         header['mjd'] = t.mjd
-        self.file.write(render_dada_header(header))
-        self.file.seek(4096)
+        # Offset of the first sample from the sync epoch, so streams can be aligned
+        bytes_per_sample = header['nchan'] * NPOL * 2
+        header['obs_offset'] = int(packet['timestamp']) // TICKS_PER_SAMPLE * int(bytes_per_sample)
+        return header
 
-    def flush(self):
-        self._timestamps = [i+TICKS_PER_HEAP for i in self._timestamps]
-        heap = self._heaps[0]
-        heap.to_dada_order().tofile(self.file)
-        heap.reset()
-        self._heaps.rotate(-1)
+    def flush(self, nheaps=1):
+        """
+        Write out the oldest nheaps heaps and advance the window past them.
+
+        Heaps beyond the end of the window were never received and are
+        written as zeros. Runs of consecutive slots are written at once.
+        """
+        while nheaps > 0:
+            first = self._head % self._nheaps
+            count = min(nheaps,self._nheaps-first)
+            slots = slice(first,first+count)
+            self.stats.heaps_flushed(self._filled[slots])
+            self._writer.write_heaps(self._data[slots].transpose(0,2,1,3,4))
+            self._data[slots] = 0
+            self._filled[slots] = False
+            self._head += count
+            nheaps -= count
+
+    def _start(self, packet):
+        nchans_in_subband = int(packet['heap_size']/packet['payload_size'])
+        self._writer = DadaWriter(self._stem,self._make_header(packet),nchans_in_subband,
+            self._opts.write_block_size,self._background,self._write_rate,
+            self._opts.compression,self._opts.chunk_size,self._opts.compress_level)
+        self._data = np.zeros((self._nheaps,nchans_in_subband,NSAMPS_PER_PACKET,NPOL,2),dtype="byte")
+        self._filled = np.zeros((self._nheaps,nchans_in_subband),dtype="bool")
+        self._base_timestamp = int(packet['timestamp'])
+        self._head = 0
+        self._last = 0
+        self._first_pass = False
 
     def add(self, packet):
+        self.add_batch(np.array([packet],dtype=packet.dtype))
+
+    def _ahead(self, heap_numbers):
+        """
+        Flag packets more than max_gap heaps beyond the highest heap kept
+        before them, e.g. from a corrupt or wrapped timestamp, so the gap is
+        not filled with zeros. Flagged packets do not move the highest heap.
+        """
+        ahead = np.zeros(heap_numbers.size,dtype="bool")
+        while True:
+            kept = np.where(ahead,self._last,heap_numbers)
+            highest = np.maximum.accumulate(np.concatenate(([self._last],kept[:-1])))
+            flagged = heap_numbers > highest + self._max_gap
+            if np.array_equal(flagged,ahead):
+                return ahead
+            ahead = flagged
+
+    def add_batch(self, packets):
+        """
+        Add packets of this stream in arrival order.
+
+        A packet is late if the window had already moved past its heap when
+        it arrived, i.e. if its heap is below the window head set by the
+        highest heap seen up to it. The other packets are scattered into
+        their heaps a window at a time in heap order, flushing heaps as the
+        window advances, which gives the same result as adding them one by
+        one.
+        """
+        if packets.size == 0:
+            return
         if self._first_pass:
-            self._write_header(packet)
-            nchans_in_subband = packet['heap_size']/packet['payload_size']
-            self._timestamps = [packet['timestamp']+i*TICKS_PER_HEAP for i in range(self._nheaps)]
-            self._heaps = deque([Heap(nchans_in_subband,NSAMPS_PER_PACKET,NPOL) for _ in range(self._nheaps)])
-            self._first_pass = False
-        try:
-            heap_id = self._timestamps.index(packet['timestamp'])
-        except ValueError as error:
-            print "Packet is too far out of order to be used"
+            self._start(packets[0])
+        self.stats.received += packets.size
+        heap_numbers = (packets['timestamp'].astype("int64") - self._base_timestamp) // TICKS_PER_HEAP
+        kept = np.flatnonzero(~self._ahead(heap_numbers))
+        if kept.size < packets.size:
+            if self.stats.ahead == 0:
+                print "Dropping packets of {} more than {} heaps ahead".format(self._stem,self._max_gap)
+            self.stats.ahead += packets.size - kept.size
+        heap_numbers = heap_numbers[kept]
+        head = np.maximum(np.maximum.accumulate(heap_numbers) - self._nheaps + 1,self._head)
+        accepted = np.flatnonzero(heap_numbers >= head)
+        self.stats.late += kept.size - accepted.size
+        if accepted.size == 0:
             return
-        if heap_id == (self._nheaps-1):
-            self.flush()
-            heap_id -= 1
-        self._heaps[heap_id].add(packet)
+        accepted = accepted[np.argsort(heap_numbers[accepted],kind="mergesort")]
+        order = kept[accepted]
+        heap_numbers = heap_numbers[accepted]
+        channels = (packets['heap_offset'][order] // packets['payload_size'][order]).astype("int64")
+        nchans = self._filled.shape[1]
+        final_head = max(self._head,int(heap_numbers[-1]) - self._nheaps + 1)
+        start = 0
+        while True:
+            end = np.searchsorted(heap_numbers,self._head + self._nheaps)
+            if end > start:
+                slots = heap_numbers[start:end] % self._nheaps
+                chans = channels[start:end]
+                # Every packet after the first of its slot and channel is a duplicate,
+                # and so is the first if the channel was already filled
+                first = np.unique(slots * nchans + chans,return_index=True)[1]
+                self.stats.duplicates += (end - start - first.size +
+                    int(np.count_nonzero(self._filled[slots[first],chans[first]])))
+                self._filled[slots,chans] = True
+                self._data[slots,chans] = packets['data'][order[start:end]]
+                start = end
+            if start == order.size:
+                break
+            # Every heap in the window has all of its packets, so flush as much
+            # of it as the final window allows, and at least enough to reach
+            # the next packet
+            self.flush(max(min(self._nheaps,final_head - self._head),
+                int(heap_numbers[start]) - self._head - self._nheaps + 1))
+        self._last = max(self._last,int(heap_numbers[-1]))
 
     def close(self):
-        for heap in self._heaps:
-            heap.to_dada_order().tofile(self.file)
-        self.file.close()
+        if not self._first_pass:
+            self.flush(self._last - self._head + 1)
+            self._writer.close()
 
 class RingBufferManager(object):
-    def __init__(self, opts):
+    def __init__(self, opts, stats_file=None):
         self._buffers = {}
         self._opts = opts
+        self._background = None
+        if opts.background_writer:
+            self._background = BackgroundWriter()
+        self._stats_file = stats_file
+        self._start = time.time()
+        self._last_dump = self._start
+        self._decode_rate = RateCounter()
+        self._assemble_rate = RateCounter()
+        self._write_rate = RateCounter()
 
-    def add(self,packet):
-        ant = packet['feng_id']
-        subband = packet['frequency']
+    def _get_buffer(self, ant, subband):
         key = (ant,subband)
         if key not in self._buffers:
-            self._buffers[key] = AntennaSubbandRingBuffer(ant,subband,self._opts)
-        self._buffers[key].add(packet)
+            self._buffers[key] = AntennaSubbandRingBuffer(ant,subband,self._opts,
+                self._background,self._write_rate)
+        return self._buffers[key]
+
+    def add(self,packet):
+        self._get_buffer(packet['feng_id'],packet['frequency']).add(packet)
+
+    def add_frames(self, frames):
+        start = time.time()
+        packets = parse_packet_batch(frames)
+        decoded = time.time()
+        self.add_batch(packets)
+        now = time.time()
+        self._decode_rate.add(packets.size,packets.size*SPEAD_FRAME_SIZE,decoded-start)
+        self._assemble_rate.add(packets.size,packets.size*SPEAD_PAYLOAD_SIZE,now-decoded)
+        if (self._stats_file is not None and self._opts.stats_interval is not None and
+            now - self._last_dump >= self._opts.stats_interval):
+            dump_stats(self.stats(),self._stats_file)
+            self._last_dump = now
+
+    def stats(self):
+        return {
+            "elapsed": time.time() - self._start,
+            "decode": self._decode_rate.to_dict(),
+            "assemble": self._assemble_rate.to_dict(),
+            "write": self._write_rate.to_dict(),
+            "streams": dict(("{}:{}".format(*key),rb.stats.to_dict())
+                for key,rb in self._buffers.items())
+        }
+
+    def add_batch(self, packets):
+        if packets.size == 0:
+            return
+        keys = (packets['feng_id'] << np.uint64(32)) | packets['frequency']
+        order = np.argsort(keys, kind="mergesort")
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for group in np.split(packets[order], bounds):
+            ant = int(group[0]['feng_id'])
+            subband = int(group[0]['frequency'])
+            self._get_buffer(ant,subband).add_batch(group)
 
     def close_all(self):
         for key,rb in self._buffers.items():
             rb.close()
+        if self._background is not None:
+            self._background.stop()
 
-def stream_to_buffers(packet_generator, opts):
-    rb_manager = RingBufferManager(opts)
-    max_packets = opts.npackets
-    packet_count = 0
+def _shard_worker(worker_id, opts, slots, work_queue, free_queue, stats_queue):
+    # Ctrl-C reaches the whole process group; the parent decides when to
+    # stop and then drains the workers through close_all
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    stats_file = None
+    if opts.stats_file is not None:
+        stats_file = "{}.{}".format(opts.stats_file,worker_id)
+    rb_manager = RingBufferManager(opts,stats_file)
     while True:
-        packet = packet_generator.next()
-        if packet[0] is None:
+        item = work_queue.get()
+        if item is None:
             break
-        else:
-            rb_manager.add(parse_packet_lite(packet[1]))
-        packet_count+=1
-        if max_packets is not None:
-            if packet_count >= max_packets:
-                break
+        slot_id,count = item
+        frames = np.frombuffer(slots[slot_id],dtype=frame_dtype(SPEAD_FRAME_SIZE),count=count)
+        rb_manager.add_frames(frames)
+        free_queue.put(slot_id)
     rb_manager.close_all()
+    stats_queue.put(rb_manager.stats())
+
+class ShardedRingBufferManager(object):
+    """
+    Spread the (feng_id, subband) ring buffers over worker processes.
+
+    Each stream is pinned to one worker the first time it is seen, so every
+    worker owns a disjoint set of ring buffers and output files. Raw frames
+    are handed to the workers through a small ring of shared memory slots
+    per worker; only slot ids travel over the queues.
+    """
+    def __init__(self, opts):
+        self._opts = opts
+        self._nworkers = opts.workers
+        self._shard_map = {}
+        slot_size = opts.batch_size * SPEAD_FRAME_SIZE
+        self._slots = []
+        self._work_queues = []
+        self._free_queues = []
+        self._workers = []
+        self._stats_queue = multiprocessing.Queue()
+        self._stats = None
+        for worker_id in range(self._nworkers):
+            slots = [RawArray("c",slot_size) for _ in range(NSLOTS_PER_WORKER)]
+            work_queue = multiprocessing.Queue()
+            free_queue = multiprocessing.Queue()
+            for slot_id in range(NSLOTS_PER_WORKER):
+                free_queue.put(slot_id)
+            worker = multiprocessing.Process(target=_shard_worker,
+                args=(worker_id,opts,slots,work_queue,free_queue,self._stats_queue))
+            worker.start()
+            self._slots.append(slots)
+            self._work_queues.append(work_queue)
+            self._free_queues.append(free_queue)
+            self._workers.append(worker)
+
+    def _shard(self, key):
+        if key not in self._shard_map:
+            self._shard_map[key] = len(self._shard_map) % self._nworkers
+        return self._shard_map[key]
+
+    def _acquire_slot(self, worker_id):
+        while True:
+            try:
+                return self._free_queues[worker_id].get(timeout=WORKER_POLL_INTERVAL)
+            except Queue.Empty:
+                worker = self._workers[worker_id]
+                if not worker.is_alive():
+                    raise RuntimeError("Shard worker {} exited with code {}".format(
+                        worker_id,worker.exitcode))
+
+    def add_frames(self, frames):
+        frames = frames_to_array(frames)
+        keys,inverse = np.unique(stream_keys(frames.view(FRAME_DTYPE)),return_inverse=True)
+        shards = np.array([self._shard(key) for key in keys],dtype="int32")[inverse]
+        for worker_id in np.unique(shards):
+            idxs = np.flatnonzero(shards == worker_id)
+            for start in range(0,idxs.size,self._opts.batch_size):
+                chunk = idxs[start:start+self._opts.batch_size]
+                slot_id = self._acquire_slot(worker_id)
+                slot = np.frombuffer(self._slots[worker_id][slot_id],
+                    dtype=frames.dtype,count=chunk.size)
+                np.take(frames,chunk,out=slot)
+                self._work_queues[worker_id].put((slot_id,chunk.size))
+
+    def close_all(self):
+        for work_queue in self._work_queues:
+            work_queue.put(None)
+        all_stats = []
+        while len(all_stats) < self._nworkers:
+            try:
+                all_stats.append(self._stats_queue.get(timeout=WORKER_POLL_INTERVAL))
+            except Queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    break
+        self._stats = merge_stats(all_stats)
+        for worker_id,worker in enumerate(self._workers):
+            worker.join()
+            if worker.exitcode != 0:
+                raise RuntimeError("Shard worker {} exited with code {}".format(
+                    worker_id,worker.exitcode))
+
+    def stats(self):
+        return self._stats
+
+def stream_to_buffers(frame_batches, opts):
+    if opts.workers > 1:
+        rb_manager = ShardedRingBufferManager(opts)
+    else:
+        rb_manager = RingBufferManager(opts,opts.stats_file)
+    try:
+        for frames in frame_batches:
+            rb_manager.add_frames(frames)
+    finally:
+        # Write out the heaps still in the windows whatever stopped the stream
+        rb_manager.close_all()
+    stats = rb_manager.stats()
+    print format_stats(stats)
+    if opts.stats_file is not None:
+        dump_stats(stats,opts.stats_file)
+    return rb_manager
+
+def capture_live(opts):
+    receiver = MulticastReceiver(opts.group,opts.port,opts.interface,
+        opts.batch_size*LIVE_RING_BATCHES,opts.rcvbuf)
+    def interrupt(signum, frame):
+        print "Live capture interrupted"
+        receiver.stop()
+    # Ctrl-C only ends the capture between batches, so a heap is never left
+    # half assembled or half written
+    previous = signal.signal(signal.SIGINT,interrupt)
+    try:
+        frame_batches = receiver.batches(opts.batch_size,opts.npackets,opts.duration)
+        rb_manager = stream_to_buffers(frame_batches,opts)
+    finally:
+        signal.signal(signal.SIGINT,previous)
+        receiver.report()
+        receiver.close()
     return rb_manager
 
 def main(opts):
-    packet_generator = pcapy.open_offline(opts.fname)
-    return stream_to_buffers(packet_generator,opts)
+    if opts.group is not None:
+        return capture_live(opts)
+    if opts.build_index:
+        load_packet_index(opts.fname,opts.batch_size,rebuild=True)
+        return None
+    if opts.feng_ids is None and opts.subbands is None and opts.time_range is None:
+        reader = PcapReader(opts.fname)
+        indices = None
+        if opts.npackets is not None:
+            indices = np.arange(min(opts.npackets,len(reader)))
+        frame_batches = reader.batches(opts.batch_size,SPEAD_FRAME_SIZE,indices)
+    else:
+        index = load_packet_index(opts.fname,opts.batch_size)
+        # Timestamps count ADC samples, which are taken at twice the bandwidth
+        offsets = select_packets(index,opts.feng_ids,opts.subbands,opts.time_range,
+            2 * opts.bandwidth * 1e6)
+        print "Selected {} of {} packets".format(offsets.size,index.size)
+        if opts.npackets is not None:
+            offsets = offsets[:opts.npackets]
+        reader = PcapReader(opts.fname,build_index=False)
+        frame_batches = reader.batches_at(offsets,opts.batch_size,SPEAD_FRAME_SIZE)
+    rb_manager = stream_to_buffers(frame_batches,opts)
+    reader.close()
+    return rb_manager
 
-if __name__ == "__main__":
-    from argparse import ArgumentParser
+def make_parser():
     usage = "usage: {prog} [options]".format(prog=sys.argv[0])
     parser = ArgumentParser(usage=usage)
     required = parser.add_argument_group('required arguments')
     required.add_argument('-i','--fname', dest='fname', type=str,
-        help='The name of the pcap file to read.')
+        help='The name of the pcap file to read (not needed with --group).')
     required.add_argument('-c','--nchan', dest='nchan', type=int,
         help='The number of F-engine channels, e.g. 4096')
     required.add_argument('-t','--global_sync_epoch', dest='global_sync_epoch', type=float,
         help='The unix time global synchronization epoch', default=0.0)
     optional = parser.add_argument_group('optional arguments')
     optional.add_argument('-p','--prefix', dest='prefix', type=str,
-        default=None, help='A prefix for output filenames. The output format will be {prefix}_{feng_id}_{subband_id}.dada')
+        default=None, help='A prefix for output filenames. The output format will be {prefix}_{feng_id}_{subband_id}_{obs_offset}.dada')
     optional.add_argument('-n','--npackets', dest='npackets', type=int,
         default=None, help='The number of packets to read. Default is to read all packets.')
+    optional.add_argument('--batch_size', dest='batch_size', type=int,
+        default=4096, help='The number of packets to decode at once (default is 4096).')
+    optional.add_argument('--nheaps', dest='nheaps', type=int,
+        default=2, help='The number of heaps in each reorder window. Packets up to nheaps-1 heaps late are kept (default is 2).')
+    optional.add_argument('--max_gap', dest='max_gap', type=int,
+        default=MAX_HEAP_GAP, help='The largest gap in heaps filled with zeros. Packets further beyond the highest heap of their stream are dropped (default is {}).'.format(MAX_HEAP_GAP))
+    optional.add_argument('--filesize', dest='filesize', type=int,
+        default=DADA_DEFAULTS["filesize"], help='The number of data bytes per output file (default is {}).'.format(DADA_DEFAULTS["filesize"]))
+    optional.add_argument('--write_block_size', dest='write_block_size', type=int,
+        default=1048576, help='The size in bytes of the blocks written to disk (default is 1048576).')
+    optional.add_argument('--background_writer', dest='background_writer', action='store_true',
+        help='Write output files from a background thread.')
+    optional.add_argument('--compression', dest='compression', type=str, choices=sorted(COMPRESSION_CODECS),
+        default=None, help='Write the data as chunks compressed with this codec, with a chunk index after the header.')
+    optional.add_argument('--chunk_size', dest='chunk_size', type=int,
+        default=CHUNK_SIZE, help='The uncompressed size in bytes of each compressed chunk (default is {}).'.format(CHUNK_SIZE))
+    optional.add_argument('--compress_level', dest='compress_level', type=int,
+        default=1, help='The compression level, from 1 (fastest) to 9 (smallest) (default is 1).')
+    optional.add_argument('-w','--workers', dest='workers', type=int,
+        default=1, help='The number of worker processes to spread antennas/subbands over (default is 1).')
     optional.add_argument('-b','--bandwidth', dest='bandwidth', type=float,
         default=856.0, help='The total bandwidth in MHz (default is 856 MHz).')
     optional.add_argument('-f','--centre_freq', dest='cfreq', type=float,
         default=1284.0, help='The centre frequency in MHz (default is 1284 MHz).')
+    optional.add_argument('--stats_file', dest='stats_file', type=str,
+        default=None, help='Write per-stream loss and throughput statistics to this JSON file.')
+    optional.add_argument('--stats_interval', dest='stats_interval', type=float,
+        default=None, help='Also rewrite the statistics file every this many seconds during conversion.')
+    selection = parser.add_argument_group('selection arguments')
+    selection.add_argument('--build_index', dest='build_index', action='store_true',
+        help='Write the packet index for the pcap file to {fname}'+INDEX_SUFFIX+' and exit.')
+    selection.add_argument('--feng_id', dest='feng_ids', type=int, nargs='+',
+        default=None, help='Only extract these F-engine IDs (uses the packet index).')
+    selection.add_argument('--subband', dest='subbands', type=int, nargs='+',
+        default=None, help='Only extract the subbands starting at these channels (uses the packet index).')
+    selection.add_argument('--time_range', dest='time_range', type=float, nargs=2,
+        default=None, help='Only extract packets between these times in seconds from the start of the capture (uses the packet index).')
+    live = parser.add_argument_group('live capture arguments')
+    live.add_argument('-m','--group', dest='group', type=str,
+        default=None, help='Capture live from this multicast group (e.g. 239.2.1.150) instead of reading a pcap file.')
+    live.add_argument('--port', dest='port', type=int,
+        default=7148, help='The UDP port to receive on (default is 7148).')
+    live.add_argument('--interface', dest='interface', type=str,
+        default='0.0.0.0', help='The IP address of the interface to join the group on.')
+    live.add_argument('--duration', dest='duration', type=float,
+        default=None, help='The number of seconds to capture for. Default is to capture until interrupted.')
+    live.add_argument('--rcvbuf', dest='rcvbuf', type=int,
+        default=67108864, help='The socket receive buffer size in bytes (default is 67108864).')
+    return parser
+
+if __name__ == "__main__":
+    parser = make_parser()
     opts = parser.parse_args()
+    if opts.fname is None and opts.group is None:
+        parser.error("one of --fname or --group is required")
     main(opts)
@@ -0,0 +1,238 @@
+import errno
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+SETTLE_SECONDS = 0.05
+POLL_INTERVAL = 0.05
+CONNECT_TIMEOUT = 30.0
+
+class WorkerError(Exception):
+    pass
+
+
+class StageWorker(object):
+    """
+    Long-lived agent that runs the process of one pipeline stage.
+
+    The agent is started once per session (e.g. as the command of a
+    container) and listens on a unix socket for JSON requests, one per
+    line, each answered with one JSON line:
+
+        {"cmd": "ping"}                              -> {"ok": true}
+        {"cmd": "start", "args": "...", "env": {}, "log": path}
+                                                     -> {"ok": true, "pid": pid}
+        {"cmd": "wait", "timeout": seconds}          -> {"ok": true, "returncode": code}
+        {"cmd": "stop", "grace": seconds}            -> {"ok": true, "returncode": code}
+        {"cmd": "shutdown"}                          -> {"ok": true}
+
+    A start is only answered once the process has survived SETTLE_SECONDS,
+    so the answer tells the caller the stage is ready. Starting a new
+    process stops the previous one.
+    """
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._process = None
+        self._running = False
+
+    def _start(self, args, env=None, log=None, cwd=None):
+        self._stop()
+        environ = os.environ.copy()
+        environ.update(env or {})
+        output = open(log or os.devnull,"a")
+        try:
+            self._process = subprocess.Popen(shlex.split(args),env=environ,cwd=cwd,
+                stdout=output,stderr=subprocess.STDOUT)
+        finally:
+            output.close()
+        returncode = self._wait(SETTLE_SECONDS)
+        if returncode is not None:
+            return {"ok":False, "error":"exited with {} on start".format(returncode), "returncode":returncode}
+        return {"ok":True, "pid":self._process.pid}
+
+    def _wait(self, timeout=None):
+        if self._process is None:
+            return None
+        deadline = None if timeout is None else time.time() + timeout
+        while self._process.poll() is None:
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+        return self._process.returncode
+
+    def _stop(self, grace=5.0):
+        if self._process is None or self._process.poll() is not None:
+            return None if self._process is None else self._process.returncode
+        self._process.terminate()
+        if self._wait(grace) is None:
+            self._process.kill()
+            self._process.wait()
+        return self._process.returncode
+
+    def handle(self, request):
+        cmd = request.get("cmd")
+        if cmd == "ping":
+            return {"ok":True}
+        elif cmd == "start":
+            return self._start(request["args"],request.get("env"),request.get("log"),request.get("cwd"))
+        elif cmd == "wait":
+            return {"ok":True, "returncode":self._wait(request.get("timeout"))}
+        elif cmd == "stop":
+            return {"ok":True, "returncode":self._stop(request.get("grace",5.0))}
+        elif cmd == "shutdown":
+            self._running = False
+            return {"ok":True, "returncode":self._stop()}
+        return {"ok":False, "error":"unknown command {}".format(cmd)}
+
+    def serve(self):
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen(1)
+        signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+        self._running = True
+        try:
+            while self._running:
+                conn,_ = server.accept()
+                stream = conn.makefile("rw")
+                try:
+                    for line in stream:
+                        try:
+                            response = self.handle(json.loads(line))
+                        except Exception as error:
+                            response = {"ok":False, "error":str(error)}
+                        stream.write(json.dumps(response)+"\n")
+                        stream.flush()
+                        if not self._running:
+                            break
+                except socket.error:
+                    pass
+                finally:
+                    stream.close()
+                    conn.close()
+        finally:
+            self._stop()
+            server.close()
+            os.remove(self._socket_path)
+
+
+class WorkerClient(object):
+    """
+    Control connection to a StageWorker.
+    """
+    def __init__(self, socket_path, timeout=CONNECT_TIMEOUT):
+        deadline = time.time() + timeout
+        while True:
+            self._socket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                self._socket.connect(socket_path)
+                break
+            except socket.error as error:
+                self._socket.close()
+                if error.errno not in (errno.ENOENT,errno.ECONNREFUSED) or time.time() >= deadline:
+                    raise WorkerError("Could not connect to worker {}: {}".format(socket_path,error))
+                time.sleep(POLL_INTERVAL)
+        self._stream = self._socket.makefile("rw")
+
+    def request(self, cmd, **kwargs):
+        kwargs["cmd"] = cmd
+        self._stream.write(json.dumps(kwargs)+"\n")
+        self._stream.flush()
+        line = self._stream.readline()
+        if not line:
+            raise WorkerError("Worker closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise WorkerError(response["error"])
+        return response
+
+    def close(self):
+        self._stream.close()
+        self._socket.close()
+
+
+class WarmPipeline(object):
+    """
+    One StageWorker per pipeline stage, kept running for a whole session.
+
+    Workers are launched with the runtime template, e.g. a docker run
+    command, formatted with the stage name, the worker script, its
+    directory (worker_dir), its socket path and any extra fields given,
+    so container start up happens once per session. Each capture then only
+    starts the stage processes inside the running containers through the
+    control sockets. A runtime that runs the worker straight on the host
+    saves nothing over starting the stages directly.
+    """
+    def __init__(self, stages, runtime, socket_dir="/tmp", **fields):
+        self._stages = stages
+        self._runtime = runtime
+        self._socket_dir = socket_dir
+        self._fields = fields
+        self._launchers = {}
+        self._clients = {}
+
+    def _socket_path(self, stage):
+        return os.path.join(self._socket_dir,"pipeline_{}.sock".format(stage))
+
+    def start(self, timeout=CONNECT_TIMEOUT):
+        """
+        Launch the workers and return the seconds each took to be ready.
+        """
+        ready = {}
+        start = time.time()
+        worker = os.path.abspath(__file__).replace(".pyc",".py")
+        for stage in self._stages:
+            cmd = self._runtime.format(name=stage,worker=worker,worker_dir=os.path.dirname(worker),
+                socket=self._socket_path(stage),**self._fields)
+            self._launchers[stage] = subprocess.Popen(shlex.split(cmd))
+        for stage in self._stages:
+            self._clients[stage] = WorkerClient(self._socket_path(stage),timeout)
+            self._clients[stage].request("ping")
+            ready[stage] = time.time() - start
+        return ready
+
+    def run(self, stage, args, env=None, log=None, cwd=None):
+        return self._clients[stage].request("start",args=args,env=env,log=log,cwd=cwd)["pid"]
+
+    def wait(self, stage, timeout=None):
+        return self._clients[stage].request("wait",timeout=timeout)["returncode"]
+
+    def stop(self, stage, grace=5.0):
+        return self._clients[stage].request("stop",grace=grace)["returncode"]
+
+    def close(self):
+        for stage,client in self._clients.items():
+            try:
+                client.request("shutdown")
+            except (WorkerError,socket.error):
+                pass
+            client.close()
+        for launcher in self._launchers.values():
+            try:
+                if launcher.poll() is None:
+                    launcher.terminate()
+                launcher.wait()
+            except OSError:
+                pass
+        self._clients = {}
+        self._launchers = {}
+
+
+def make_parser():
+    usage = "usage: {prog} [options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-s','--socket', dest='socket', type=str, required=True,
+        help='The unix socket to listen for control requests on.')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    StageWorker(opts.socket).serve()
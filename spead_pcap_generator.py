@@ -0,0 +1,150 @@
+import struct
+import sys
+import numpy as np
+from argparse import ArgumentParser
+from pcap_to_dada import (FRAME_DTYPE, SPEAD_FRAME_SIZE, SPEAD_PAYLOAD_SIZE,
+    SPEAD_NITEMS, TICKS_PER_HEAP, NSAMPS_PER_PACKET, NPOL, UDP_PAYLOAD_OFFSET)
+
+ADC_SAMPLE_RATE = 1712e6
+SPEAD_PORT = 7148
+
+# Descriptor ids in the order the F-engines send them, padded to SPEAD_NITEMS
+ITEM_IDS = [1,2,3,4,5632,16641,16643,17152] + [0]*3
+ADDRESS_ITEM_IDS = [17152]
+HEAP_COUNTER, HEAP_SIZE, HEAP_OFFSET, PAYLOAD_SIZE, TIMESTAMP, FENG_ID, FREQUENCY = range(7)
+IMMEDIATE = 1 << 63
+
+RECORD_DTYPE = np.dtype([
+    ("ts_sec","<u4"),
+    ("ts_usec","<u4"),
+    ("incl_len","<u4"),
+    ("orig_len","<u4"),
+    ("frame",(np.void,SPEAD_FRAME_SIZE))
+    ])
+
+# Fields of each emitted packet, in file order, used to check conversions
+EMITTED_DTYPE = np.dtype([
+    ("feng_id","int32"),
+    ("frequency","int32"),
+    ("heap","int32"),
+    ("channel","int32")
+    ])
+
+def payload_pattern(feng_id, frequency, heap, channel):
+    """
+    Return the known payloads for arrays of packet coordinates.
+
+    The result has shape (npackets, NSAMPS_PER_PACKET, NPOL, 2).
+    """
+    seed = (np.asarray(feng_id,dtype="int64")*7919 + np.asarray(frequency,dtype="int64")*104729 +
+        np.asarray(heap,dtype="int64")*1299709 + np.asarray(channel,dtype="int64")*15485863)
+    data = (seed.reshape(-1,1) + np.arange(SPEAD_PAYLOAD_SIZE)) % 251 - 125
+    return data.astype("int8").reshape(-1,NSAMPS_PER_PACKET,NPOL,2)
+
+def frame_template():
+    ip_length = SPEAD_FRAME_SIZE - 14
+    udp_length = ip_length - 20
+    header = (b"\x01\x00\x5e\x02\x01\x96" + b"\x02\x00\x00\x00\x00\x01" + struct.pack("!H",0x0800) +
+        struct.pack("!BBHHHBBH",0x45,0,ip_length,0,0x4000,64,17,0) +
+        struct.pack("!4B",10,100,0,1) + struct.pack("!4B",239,2,1,150) +
+        struct.pack("!HHHH",SPEAD_PORT,SPEAD_PORT,udp_length,0) +
+        struct.pack("!BBBBHH",0x53,4,2,6,0,SPEAD_NITEMS))
+    assert len(header) == UDP_PAYLOAD_OFFSET + 8
+    return np.frombuffer(header.ljust(SPEAD_FRAME_SIZE,b"\0"),dtype="uint8")
+
+def make_frames(feng_id, frequency, heap, channel, nchans_per_subband, start_timestamp):
+    """
+    Build F-engine frames as FRAME_DTYPE records for arrays of packet coordinates.
+    """
+    raw = np.tile(frame_template(),(feng_id.size,1))
+    frames = raw.view(FRAME_DTYPE)[:,0]
+    timestamp = start_timestamp + heap.astype("uint64") * TICKS_PER_HEAP
+    items = np.zeros((feng_id.size,SPEAD_NITEMS),dtype="uint64")
+    items[:,HEAP_COUNTER] = heap
+    items[:,HEAP_SIZE] = nchans_per_subband * SPEAD_PAYLOAD_SIZE
+    items[:,HEAP_OFFSET] = channel * SPEAD_PAYLOAD_SIZE
+    items[:,PAYLOAD_SIZE] = SPEAD_PAYLOAD_SIZE
+    items[:,TIMESTAMP] = timestamp
+    items[:,FENG_ID] = feng_id
+    items[:,FREQUENCY] = frequency
+    ids = np.array(ITEM_IDS,dtype="uint64") << np.uint64(48)
+    immediate = np.array([0 if item_id in ADDRESS_ITEM_IDS else IMMEDIATE for item_id in ITEM_IDS],
+        dtype="uint64")
+    frames["items"] = items | ids | immediate
+    frames["data"] = payload_pattern(feng_id,frequency,heap,channel)
+    return frames, timestamp
+
+def write_pcap_header(f):
+    f.write(struct.pack("<IHHiIII",0xa1b2c3d4,2,4,0,0,65535,1))
+
+def generate_pcap(fname, nantennas=4, nsubbands=2, nchans_per_subband=16, nheaps=16,
+        loss=0.0, reorder=0, seed=0, start_timestamp=TICKS_PER_HEAP*1000, heaps_per_chunk=4):
+    """
+    Write a pcap file of MeerKAT F-engine SPEAD packets with known payloads.
+
+    Packets from all antennas and subbands are interleaved channel by channel
+    within each heap. A fraction loss of packets is dropped at random and,
+    if reorder is set, every packet is displaced by up to reorder places
+    (within chunks of heaps_per_chunk heaps). Returns an EMITTED_DTYPE array
+    describing the packets actually written, in file order.
+    """
+    rng = np.random.RandomState(seed)
+    heap_idx, channel, feng_id, subband = np.meshgrid(
+        np.arange(heaps_per_chunk),np.arange(nchans_per_subband),
+        np.arange(nantennas),np.arange(nsubbands),indexing="ij")
+    emitted = []
+    with open(fname,"wb") as f:
+        write_pcap_header(f)
+        for first_heap in range(0,nheaps,heaps_per_chunk):
+            keep = (heap_idx + first_heap < nheaps).ravel()
+            chunk = np.empty(keep.sum(),dtype=EMITTED_DTYPE)
+            chunk["heap"] = (heap_idx.ravel() + first_heap)[keep]
+            chunk["channel"] = channel.ravel()[keep]
+            chunk["feng_id"] = feng_id.ravel()[keep]
+            chunk["frequency"] = subband.ravel()[keep] * nchans_per_subband
+            if reorder:
+                chunk = chunk[np.argsort(np.arange(chunk.size) + rng.uniform(0,reorder,chunk.size),
+                    kind="mergesort")]
+            if loss:
+                chunk = chunk[rng.uniform(size=chunk.size) >= loss]
+            frames, timestamp = make_frames(chunk["feng_id"],chunk["frequency"],chunk["heap"],
+                chunk["channel"],nchans_per_subband,start_timestamp)
+            records = np.zeros(chunk.size,dtype=RECORD_DTYPE)
+            seconds = timestamp / ADC_SAMPLE_RATE
+            records["ts_sec"] = seconds.astype("uint32")
+            records["ts_usec"] = ((seconds % 1) * 1e6).astype("uint32")
+            records["incl_len"] = SPEAD_FRAME_SIZE
+            records["orig_len"] = SPEAD_FRAME_SIZE
+            records["frame"] = frames.view(RECORD_DTYPE["frame"])
+            records.tofile(f)
+            emitted.append(chunk)
+    return np.concatenate(emitted)
+
+def make_parser():
+    usage = "usage: {prog} [options]".format(prog=sys.argv[0])
+    parser = ArgumentParser(usage=usage)
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-o','--fname', dest='fname', type=str, required=True,
+        help='The name of the pcap file to write.')
+    optional = parser.add_argument_group('optional arguments')
+    optional.add_argument('-a','--nantennas', dest='nantennas', type=int,
+        default=4, help='The number of F-engines (default is 4).')
+    optional.add_argument('-s','--nsubbands', dest='nsubbands', type=int,
+        default=2, help='The number of subbands per F-engine (default is 2).')
+    optional.add_argument('-c','--nchans_per_subband', dest='nchans_per_subband', type=int,
+        default=16, help='The number of channels in each heap (default is 16).')
+    optional.add_argument('-n','--nheaps', dest='nheaps', type=int,
+        default=16, help='The number of heaps per stream (default is 16).')
+    optional.add_argument('-l','--loss', dest='loss', type=float,
+        default=0.0, help='The fraction of packets to drop (default is 0).')
+    optional.add_argument('-r','--reorder', dest='reorder', type=int,
+        default=0, help='The maximum number of places a packet is displaced by (default is 0).')
+    optional.add_argument('--seed', dest='seed', type=int,
+        default=0, help='The random seed for loss and reordering (default is 0).')
+    return parser
+
+if __name__ == "__main__":
+    opts = make_parser().parse_args()
+    emitted = generate_pcap(opts.fname,opts.nantennas,opts.nsubbands,opts.nchans_per_subband,
+        opts.nheaps,opts.loss,opts.reorder,opts.seed)
+    print "Wrote {} packets to {}".format(emitted.size,opts.fname)